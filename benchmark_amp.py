@@ -0,0 +1,79 @@
+import argparse
+import time
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+
+from lib.models.unet import UNet
+from lib.utils.net_utils import RefinementLoss, get_gamma_tensor, setup_device, \
+    synchronize, autocast, create_grad_scaler, reset_peak_memory, peak_memory
+
+# =================PARAMETERS=============================== #
+parser = argparse.ArgumentParser(description='Compare training throughput and memory of float32 and --amp')
+
+parser.add_argument('--device', type=str, default='cuda', help='device to train on, e.g. cuda, cuda:1 or cpu')
+parser.add_argument('--batch_size', type=int, default=8, help='input batch size')
+parser.add_argument('--height', type=int, default=480)
+parser.add_argument('--width', type=int, default=640)
+parser.add_argument('--iters', type=int, default=20, help='number of timed iterations')
+parser.add_argument('--warmup', type=int, default=3, help='number of untimed iterations')
+
+opt = parser.parse_args()
+print(opt)
+
+device = setup_device(opt.device)
+gamma = get_gamma_tensor(opt.height, opt.width, 600, 600, device=device)
+# ========================================================== #
+
+
+# random inputs shaped like the InteriorNet training batches
+B, H, W = opt.batch_size, opt.height, opt.width
+depth_gt = torch.rand(B, 1, H, W) * 5 + 0.5
+depth_coarse = depth_gt * (1 + 0.05 * torch.randn(B, 1, H, W))
+occlusion = torch.zeros(B, 9, H, W)
+occlusion[:, 0] = (torch.rand(B, H, W) > 0.95).float()
+occlusion[:, 1:] = torch.randint(-1, 2, (B, 8, H, W)).float() * occlusion[:, :1]
+normal = F.normalize(torch.randn(B, 3, H, W), dim=1)
+depth_gt, depth_coarse, occlusion, normal = [x.to(device) for x in (depth_gt, depth_coarse, occlusion, normal)]
+
+
+def benchmark(amp):
+    """Return the training throughput in images/s and the peak memory in MB, None on CPU"""
+    torch.manual_seed(0)
+    net = UNet(use_occ=True).to(device)
+    optimizer = optim.Adam(net.parameters(), lr=0.0001)
+    scaler = create_grad_scaler(device, amp)
+    criterion = RefinementLoss(15. / 1000, 1, alpha_change=1.).to(device)
+
+    net.train()
+    reset_peak_memory(device)
+    for i in range(opt.warmup + opt.iters):
+        if i == opt.warmup:
+            synchronize(device)
+            begin = time.time()
+
+        with autocast(device, amp):
+            depth_refined = net(depth_coarse, occlusion, None)
+            loss, _ = criterion(depth_refined, depth_gt, depth_coarse, occlusion, normal, gamma)
+
+        optimizer.zero_grad()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+    synchronize(device)
+    return opt.iters * opt.batch_size / (time.time() - begin), peak_memory(device)
+
+
+fp32_throughput, fp32_memory = benchmark(False)
+amp_throughput, amp_memory = benchmark(True)
+
+print('{}x{} on {}, batch size {}'.format(H, W, device, B))
+if fp32_memory is not None:
+    print('fp32: {:.1f} images/s, peak memory {:.0f} MB'.format(fp32_throughput, fp32_memory))
+    print('amp : {:.1f} images/s, peak memory {:.0f} MB'.format(amp_throughput, amp_memory))
+    print('amp speedup {:.2f}x, memory ratio {:.2f}'.format(amp_throughput / fp32_throughput, amp_memory / fp32_memory))
+else:
+    print('fp32: {:.1f} images/s'.format(fp32_throughput))
+    print('amp : {:.1f} images/s'.format(amp_throughput))
+    print('amp speedup {:.2f}x'.format(amp_throughput / fp32_throughput))
@@ -0,0 +1,36 @@
+import argparse
+import os
+import sys
+from tqdm import tqdm
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.utils.data_utils import save_occlusion_label
+from lib.utils.io_utils import atomic_write
+
+
+parser = argparse.ArgumentParser(description='Convert (H, W, 9) occlusion labels into the compact .npz encoding')
+
+parser.add_argument('--label_dir', type=str, required=True, help='folder searched recursively for labels')
+parser.add_argument('--label_ext', type=str, default='-order-pix.npy')
+parser.add_argument('--packed', action='store_true', help='pack the orientations by 2 bits instead of int8 planes')
+parser.add_argument('--remove', action='store_true', help='remove the raw labels once converted')
+
+opt = parser.parse_args()
+
+label_paths = []
+for root, _, names in os.walk(opt.label_dir):
+    label_paths += [os.path.join(root, name) for name in names if name.endswith(opt.label_ext)]
+
+size_in, size_out = 0, 0
+for label_path in tqdm(sorted(label_paths)):
+    out_path = label_path[:-4] + '.npz'
+    if not os.path.exists(out_path):
+        atomic_write(out_path, lambda path: save_occlusion_label(path, np.load(label_path), opt.packed))
+
+    size_in += os.path.getsize(label_path)
+    size_out += os.path.getsize(out_path)
+    if opt.remove:
+        os.remove(label_path)
+
+print('converted {} labels from {:.1f} MB to {:.1f} MB'.format(len(label_paths), size_in / 2 ** 20, size_out / 2 ** 20))
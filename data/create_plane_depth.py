@@ -1,58 +1,86 @@
 import argparse
 import os
+import sys
+import time
 import numpy as np
 import pandas as pd
 import cv2
-from math import atan, tan, pi
+from multiprocessing import Pool
 from tqdm import tqdm
-import itertools
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.utils.net_utils import create_gamma_matrix
+from lib.utils.io_utils import atomic_write
 
-def point_to_plane(depth, fx=600, fy=600):
-    H, W = depth.shape
-    depth_plane = depth.copy()
 
-    # compute field of view
-    fov_x = 2 * atan(W / (2 * fx))
-    fov_y = 2 * atan(H / (2 * fy))
+# per-process cache of the point-to-plane scale keyed by (H, W, fx, fy)
+_PLANE_SCALE_CACHE = {}
 
-    for i, j in itertools.product(range(H), range(W)):
-        alpha_x = (pi - fov_x) / 2
-        gamma_x = alpha_x + fov_x * ((W - j) / W)
 
-        alpha_y = (pi - fov_y) / 2
-        gamma_y = alpha_y + fov_y * ((H - i) / H)
+def plane_scale(H, W, fx=600, fy=600):
+    """Ratio between plane-to-plane and point-to-point depth for every pixel, in shape of [H, W]"""
+    key = (H, W, fx, fy)
+    if key not in _PLANE_SCALE_CACHE:
+        gamma = create_gamma_matrix(H, W, fx, fy)
+        cot_x = 1 / np.tan(gamma[:, :, 0])
+        cot_y = 1 / np.tan(gamma[:, :, 1])
+        _PLANE_SCALE_CACHE[key] = 1 / np.sqrt(1 + cot_x ** 2 + cot_y ** 2)
+    return _PLANE_SCALE_CACHE[key]
 
-        depth_plane[i, j] = np.sqrt(depth[i, j] ** 2 / (1 + 1 / (tan(gamma_x) ** 2) + 1 / (tan(gamma_y) ** 2)))
 
+def point_to_plane(depth, fx=600, fy=600):
+    H, W = depth.shape
+    depth_plane = depth.astype(np.float64) * plane_scale(H, W, fx, fy)
     return depth_plane.astype(depth.dtype)
 
 
-parser = argparse.ArgumentParser(description='Transform depth maps to point cloud given the camera intrinsics')
-
-parser.add_argument('--data_dir', type=str, default=None, help='path to interior net dataset')
-parser.add_argument('--gt_dir', type=str, default='data', help='folder containing depth map')
-parser.add_argument('--csv_file', type=str, default='InteriorNet.txt', help='csv file')
-parser.add_argument('--label_name', type=str, default='_raycastingV2', help='occlusion label name')
-parser.add_argument('--depth_ext', type=str, default='-depth.png')
-parser.add_argument('--depth_plane_ext', type=str, default='-depth-plane.png')
-
-opt = parser.parse_args()
-
-df = pd.read_csv(os.path.join(opt.data_dir, opt.csv_file))
-
-for index in tqdm(range(len(df))):
-    depth_path = os.path.join(opt.data_dir, opt.gt_dir,
-                              '{}{}'.format(df.iloc[index]['scene'], opt.label_name),
-                              '{:04d}{}'.format(df.iloc[index]['image'], opt.depth_ext))
-
-    depth_plane_path = depth_path.replace(opt.depth_ext, opt.depth_plane_ext)
+def convert_depth(paths):
+    """Convert one depth map and write it atomically, return False if the output already exists"""
+    depth_path, depth_plane_path = paths
     if os.path.exists(depth_plane_path):
-        continue
+        return False
 
     depth = cv2.imread(depth_path, -1)
     depth_plane = point_to_plane(depth)
-    cv2.imwrite(depth_plane_path, depth_plane)
 
-    assert os.path.exists(depth_plane_path)
+    atomic_write(depth_plane_path, lambda path: cv2.imwrite(path, depth_plane))
 
+    assert os.path.exists(depth_plane_path)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Transform depth maps to point cloud given the camera intrinsics')
+
+    parser.add_argument('--data_dir', type=str, default=None, help='path to interior net dataset')
+    parser.add_argument('--gt_dir', type=str, default='data', help='folder containing depth map')
+    parser.add_argument('--csv_file', type=str, default='InteriorNet.txt', help='csv file')
+    parser.add_argument('--label_name', type=str, default='_raycastingV2', help='occlusion label name')
+    parser.add_argument('--depth_ext', type=str, default='-depth.png')
+    parser.add_argument('--depth_plane_ext', type=str, default='-depth-plane.png')
+    parser.add_argument('--workers', type=int, default=0, help='number of conversion processes, 0 to run serially')
+    parser.add_argument('--chunksize', type=int, default=16, help='number of depth maps sent to a worker at once')
+
+    opt = parser.parse_args()
+
+    df = pd.read_csv(os.path.join(opt.data_dir, opt.csv_file))
+
+    jobs = []
+    for scene, image in zip(df['scene'], df['image']):
+        depth_path = os.path.join(opt.data_dir, opt.gt_dir,
+                                  '{}{}'.format(scene, opt.label_name),
+                                  '{:04d}{}'.format(image, opt.depth_ext))
+        depth_plane_path = depth_path.replace(opt.depth_ext, opt.depth_plane_ext)
+        jobs.append((depth_path, depth_plane_path))
+
+    begin = time.time()
+    if opt.workers > 0:
+        with Pool(opt.workers) as pool:
+            done = list(tqdm(pool.imap_unordered(convert_depth, jobs, chunksize=opt.chunksize), total=len(jobs)))
+    else:
+        done = [convert_depth(job) for job in tqdm(jobs)]
+    elapsed = time.time() - begin
+
+    num_converted = sum(done)
+    print('converted {} depth maps, skipped {} existing ones in {:.1f}s ({:.1f} images/s)'.format(
+        num_converted, len(jobs) - num_converted, elapsed, num_converted / max(elapsed, 1e-9)))
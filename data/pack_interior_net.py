@@ -0,0 +1,85 @@
+import argparse
+import os
+import sys
+import json
+import numpy as np
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.datasets.interior_net import InteriorNet, shard_dtype
+from lib.utils.io_utils import atomic_write
+
+
+parser = argparse.ArgumentParser(description='Pack InteriorNet training samples into contiguous shard files')
+
+parser.add_argument('--root_dir', type=str, default='/space_sdd/InteriorNet', help='path to interior net dataset')
+parser.add_argument('--out_dir', type=str, default='/space_sdd/InteriorNet/shards', help='output folder of the shards')
+parser.add_argument('--method_name', type=str, default='sharpnet_pred')
+parser.add_argument('--label_name', type=str, default='_raycastingV2', help='occlusion label name')
+parser.add_argument('--shard_size', type=int, default=256, help='number of samples per shard')
+parser.add_argument('--height', type=int, default=480)
+parser.add_argument('--width', type=int, default=640)
+
+opt = parser.parse_args()
+
+dataset = InteriorNet(opt.root_dir, label_name=opt.label_name, method_name=opt.method_name)
+dtype = shard_dtype(opt.height, opt.width)
+if not os.path.isdir(opt.out_dir):
+    os.makedirs(opt.out_dir)
+
+
+def shard_meta(begin, end):
+    """Packing settings and samples of a shard, stored in a sidecar json to detect stale shards"""
+    return {'method_name': opt.method_name, 'label_name': opt.label_name, 'height': opt.height, 'width': opt.width,
+            'begin': begin, 'num_samples': end - begin,
+            'scenes': dataset.df['scene'].iloc[begin:end].tolist(), 'images': dataset.df['image'].iloc[begin:end].tolist()}
+
+
+def is_packed(shard_path, meta_path, meta):
+    """Whether the shard exists and was packed with the same settings and samples"""
+    if not os.path.exists(shard_path) or not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        if json.load(f) != meta:
+            return False
+    shard = np.load(shard_path, mmap_mode='r')
+    return shard.dtype == dtype and shard.shape == (meta['num_samples'],)
+
+
+def write_shard(path, begin, end):
+    shard = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(end - begin,))
+    for i in range(begin, end):
+        depth_gt, depth_pred, label, normal, img = dataset._fetch_raw(i)
+        shard[i - begin] = (depth_gt, depth_pred, label[:, :, 0], np.rint(label[:, :, 1:]), normal, img)
+    shard.flush()
+    del shard
+
+
+def write_meta(path, meta):
+    with open(path, 'w') as f:
+        json.dump(meta, f)
+
+
+shards = []
+for shard_id, begin in enumerate(tqdm(range(0, len(dataset), opt.shard_size), desc='packing shards')):
+    end = min(begin + opt.shard_size, len(dataset))
+    shard_file = 'shard_{:05d}.npy'.format(shard_id)
+    shard_path = os.path.join(opt.out_dir, shard_file)
+    meta_path = os.path.join(opt.out_dir, 'shard_{:05d}.json'.format(shard_id))
+    meta = shard_meta(begin, end)
+    shards.append({'file': shard_file, 'num_samples': end - begin})
+    if is_packed(shard_path, meta_path, meta):
+        continue
+
+    # the sidecar is removed first so that it never describes a shard of another run
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    # an interrupted run only repacks the last shard
+    atomic_write(shard_path, lambda path: write_shard(path, begin, end))
+    atomic_write(meta_path, lambda path: write_meta(path, meta))
+
+index = {'height': opt.height, 'width': opt.width, 'method_name': opt.method_name, 'label_name': opt.label_name,
+         'scenes': dataset.df['scene'].tolist(), 'images': dataset.df['image'].tolist(), 'shards': shards}
+atomic_write(os.path.join(opt.out_dir, 'index.json'), lambda path: write_meta(path, index))
+print('packed {} samples into {} shards'.format(len(dataset), len(shards)))
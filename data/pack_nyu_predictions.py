@@ -0,0 +1,27 @@
+import argparse
+import os
+import sys
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.utils.data_utils import get_prediction_source, pack_predictions, packed_prediction_paths, PRED_STORE_DIR
+
+
+parser = argparse.ArgumentParser(description='Pack NYUv2 depth predictions into memory-mapped float32 arrays')
+
+parser.add_argument('--methods', type=str, nargs='+',
+                    default=['jiao', 'laina', 'sharpnet', 'eigen', 'dorn', 'bts', 'vnl'])
+parser.add_argument('--store_dir', type=str, default=PRED_STORE_DIR, help='output folder of the packed predictions')
+parser.add_argument('--overwrite', action='store_true', help='repack methods which are already packed')
+
+opt = parser.parse_args()
+
+for method in tqdm(opt.methods):
+    if os.path.exists(packed_prediction_paths(method, opt.store_dir)[1]) and not opt.overwrite:
+        print('{} is already packed, skipping'.format(method))
+        continue
+
+    # read from the raw prediction files
+    depths = get_prediction_source(method, store_dir=None)
+    pack_predictions(method, depths, opt.store_dir)
+    print('packed {} predictions of {}'.format(len(depths), method))
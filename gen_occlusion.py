@@ -1,14 +1,11 @@
 from lib.utils.net_utils import create_gamma_matrix
 from lib.utils.data_utils import neighbor_depth_variation_tangent, neighbor_depth_variation, normalize_depth_map
+from lib.utils.colormap import save_colorized
 import numpy as np
 import cv2
 import os
 from skimage import feature
 
-import matplotlib
-matplotlib.use('agg')  # use matplotlib without GUI support
-import matplotlib.pyplot as plt
-
 
 thresh = 200 / 1000
 out_dir = '/space_sdd/ibims/yang_contour'
@@ -45,7 +42,7 @@ depth_normalized = normalize_depth_map(depth)
 
 # apply canny filter to both depth variations
 edges_est = feature.canny(depth_normalized, sigma=np.sqrt(2), low_threshold=0.15, high_threshold=0.3)
-plt.imsave(os.path.join(out_dir, 'occlusion.png'), edges_est)
+save_colorized(os.path.join(out_dir, 'occlusion.png'), edges_est)
 
 # iteration on all pixel neighborhoods
 for i in range(8):
@@ -61,4 +58,4 @@ for i in range(8):
     contour_tangent[mask] = 255
 
     cv2.imwrite(os.path.join(out_dir, 'variation_corrected_{}.png'.format(i)), var_tangent * 30)
-    plt.imsave(os.path.join(out_dir, 'occlusion_corrected_{}.png'.format(i)), contour_tangent)
+    save_colorized(os.path.join(out_dir, 'occlusion_corrected_{}.png'.format(i)), contour_tangent)
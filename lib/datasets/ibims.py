@@ -1,5 +1,6 @@
 import os
 from os.path import join
+import hashlib
 import torch
 import numpy as np
 import cv2
@@ -7,12 +8,23 @@ from scipy import io
 
 import torch.utils.data as data
 
+from lib.utils.data_utils import load_occlusion_label
+from lib.utils.io_utils import atomic_write
+
 
 class Ibims(data.Dataset):
+    """
+    iBims-1 images with depth predictions of a method and occlusion labels.
+    With cache='memory' or cache='disk', decoded samples are kept in memory or saved as tensors in cache_dir,
+    keyed by the paths and modification times of their source files and by th, so that later validation
+    passes skip parsing. The memory cache lives in the loading process, use persistent workers to keep it.
+    """
     def __init__(self, root_dir, method_name, th=None,
                  im_dir='ibims1_core_raw/rgb', gt_dir='gt_depth',
-                 label_dir='label', label_ext='-order-pix.npy'):
+                 label_dir='label', label_ext='-order-pix.npy', cache=None, cache_dir=None):
         super(Ibims, self).__init__()
+        assert cache in [None, 'memory', 'disk'], 'unknown cache {}'.format(cache)
+        assert cache != 'disk' or cache_dir is not None, 'a cache_dir is required by the disk cache'
         self.root_dir = root_dir
         self.im_dir = im_dir
         self.gt_dir = gt_dir
@@ -20,6 +32,11 @@ class Ibims(data.Dataset):
         self.label_ext = label_ext
         self.method_name = method_name
         self.th = th
+        self.cache = cache
+        self.cache_dir = cache_dir
+        self._memory_cache = dict()
+        if cache == 'disk' and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
         with open(join(self.root_dir, 'imagelist.txt')) as f:
             image_names = f.readlines()
         self.im_names = [x.strip() for x in image_names]
@@ -28,39 +45,62 @@ class Ibims(data.Dataset):
         return len(self.im_names)
 
     def __getitem__(self, index):
+        if self.cache is None:
+            return self._load_sample(index)
+
+        key = self._cache_key(index)
+        if self.cache == 'memory':
+            if index not in self._memory_cache or self._memory_cache[index][0] != key:
+                self._memory_cache[index] = (key, self._load_sample(index))
+            return self._memory_cache[index][1]
+
+        cache_path = join(self.cache_dir, '{}_{}.pth'.format(
+            self.im_names[index], hashlib.md5(repr(key).encode()).hexdigest()[:16]))
+        if os.path.exists(cache_path):
+            return torch.load(cache_path)
+        sample = self._load_sample(index)
+        atomic_write(cache_path, lambda path: torch.save(sample, path))
+        return sample
+
+    def _cache_key(self, index):
+        paths = self._sample_paths(index)
+        return tuple((path, os.path.getmtime(path)) for path in paths) + (self.th,)
+
+    def _sample_paths(self, index):
+        depth_gt_mat = join(self.root_dir, self.gt_dir, '{}.mat'.format(self.im_names[index]))
+        depth_pred_mat = join(self.root_dir, self.method_name, '{}_predictions_{}_results.mat'.format(
+            self.im_names[index], self.method_name))
+        label_path = join(self.root_dir, self.label_dir, self.im_names[index] + self.label_ext)
+        normal_path = join(self.root_dir, 'normal', '{}-normal.png'.format(self.im_names[index]))
+        img_path = join(self.root_dir, self.im_dir, '{}.png'.format(self.im_names[index]))
+        return depth_gt_mat, depth_pred_mat, label_path, normal_path, img_path
+
+    def _load_sample(self, index):
         depth_gt, depth_pred, label, edge, normal, img = self._fetch_data(index)
 
         depth_gt = torch.from_numpy(np.ascontiguousarray(depth_gt)).float().unsqueeze(0)
         depth_pred = torch.from_numpy(np.ascontiguousarray(depth_pred)).float().unsqueeze(0)
         label = torch.from_numpy(np.ascontiguousarray(label)).float().permute(2, 0, 1)
+        edge = torch.from_numpy(np.ascontiguousarray(edge))
         normal = torch.from_numpy(np.ascontiguousarray(normal)).float().permute(2, 0, 1)
         img = torch.from_numpy(np.ascontiguousarray(img)).float().permute(2, 0, 1)
 
         return depth_gt, depth_pred, label, edge, normal, img
 
     def _fetch_data(self, index):
+        depth_gt_mat, depth_pred_mat, label_path, normal_path, img_path = self._sample_paths(index)
+
         # fetch depth map in meters
-        depth_gt_mat = join(self.root_dir, self.gt_dir, '{}.mat'.format(self.im_names[index]))
-        depth_pred_mat = join(self.root_dir, self.method_name, '{}_predictions_{}_results.mat'.format(
-            self.im_names[index], self.method_name))
         depth_gt, depth_pred, edge = self._load_depths_from_mat(depth_gt_mat, depth_pred_mat)
 
-        # fetch occlusion orientation labels
-        label_path = join(self.root_dir, self.label_dir, self.im_names[index] + self.label_ext)
-        label = np.load(label_path)
-
-        # remove predictions with small score
-        if self.th is not None:
-            mask = label[:, :, 0] <= self.th
-            label[mask, 1:] = 0
+        # fetch occlusion orientation labels and remove predictions with small score
+        label = load_occlusion_label(label_path, self.th)
 
         # fetch normal map
-        normal_path = join(self.root_dir, 'normal', '{}-normal.png'.format(self.im_names[index]))
         normal = cv2.imread(normal_path, -1) / (2 ** 16 - 1) * 2 - 1
         normal = normal[:, :, ::-1]
 
         # fetch rgb image
-        img_path = join(self.root_dir, self.im_dir, '{}.png'.format(self.im_names[index]))
         img = cv2.imread(img_path, -1) / 255
         img = img[:, :, ::-1]
 
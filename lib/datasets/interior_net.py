@@ -1,5 +1,6 @@
 import os
 from os.path import join
+import json
 import cv2
 import pickle
 import torch
@@ -8,6 +9,8 @@ import pandas as pd
 
 import torch.utils.data as data
 
+from lib.utils.data_utils import load_occlusion_label
+
 
 class InteriorNet(data.Dataset):
     def __init__(self, root_dir, label_name='_raycastingV2',
@@ -42,43 +45,118 @@ class InteriorNet(data.Dataset):
         return depth_gt, depth_pred, label, normal, img
 
     def _fetch_data(self, index):
+        depth_gt, depth_pred, label, normal, img = self._fetch_raw(index)
+        return self._decode(depth_gt, depth_pred, label, normal, img)
+
+    @staticmethod
+    def _decode(depth_gt, depth_pred, label, normal, img):
+        """Convert the raw depth in millimeters and the 16-bit normal and 8-bit rgb in BGR order"""
+        # ground truth depth map in meters
+        depth_gt = depth_gt / 1000
+
+        # normal map in norm-1 vectors
+        normal = normal / (2 ** 16 - 1) * 2 - 1
+        normal = normal[:, :, ::-1]
+
+        # rgb image
+        img = img / 255
+        img = img[:, :, ::-1]
+
+        return depth_gt, depth_pred, label, normal, img
+
+    def _fetch_raw(self, index):
         # fetch predicted depth map in meters
         depth_pred_path = join(self.root_dir, self.pred_dir, self.df.iloc[index]['scene'],
                                self.method_name, 'data', '{}.pkl'.format(self.df.iloc[index]['image']))
         with open(depth_pred_path, 'rb') as f:
             depth_pred = pickle.load(f)
 
-        # fetch ground truth depth map in meters
+        # fetch ground truth depth map in millimeters
         depth_gt_path = join(self.root_dir, self.gt_dir, 
                              '{}{}'.format(self.df.iloc[index]['scene'], self.label_name),
                              '{:04d}{}'.format(self.df.iloc[index]['image'], self.depth_ext))
         if not os.path.exists(depth_gt_path):
             print(depth_gt_path)
-        depth_gt = cv2.imread(depth_gt_path, -1) / 1000
+        depth_gt = cv2.imread(depth_gt_path, -1)
 
-        # fetch normal map in norm-1 vectors
+        # fetch 16-bit normal map
         normal_path = join(self.root_dir, self.gt_dir,
                            '{}{}'.format(self.df.iloc[index]['scene'], self.label_name),
                            '{:04d}{}'.format(self.df.iloc[index]['image'], self.normal_ext))
-        normal = cv2.imread(normal_path, -1) / (2 ** 16 - 1) * 2 - 1
-        normal = normal[:, :, ::-1]
+        normal = cv2.imread(normal_path, -1)
 
-        # fetch rgb image
+        # fetch 8-bit rgb image
         image_path = join(self.root_dir, self.gt_dir,
                           '{}{}'.format(self.df.iloc[index]['scene'], self.label_name),
                           '{:04d}{}'.format(self.df.iloc[index]['image'], self.im_ext))
-        img = cv2.imread(image_path, -1) / 255
-        img = img[:, :, ::-1]
+        img = cv2.imread(image_path, -1)
 
         # fetch occlusion orientation labels
         label_path = join(self.root_dir, self.label_dir, 
                           '{}{}'.format(self.df.iloc[index]['scene'], self.label_name),
                           '{:04d}{}'.format(self.df.iloc[index]['image'], self.label_ext))
-        label = np.load(label_path)
+        label = load_occlusion_label(label_path)
 
         return depth_gt, depth_pred, label, normal, img
 
 
+def shard_dtype(H=480, W=640):
+    """Record of one packed InteriorNet sample, raw values are kept so decoding matches InteriorNet"""
+    return np.dtype([('depth_gt', '<u2', (H, W)),  # depth in millimeters
+                     ('depth_pred', '<f4', (H, W)),  # predicted depth in meters, float16 is too coarse for it
+                     ('score', '<f4', (H, W)),  # occlusion score
+                     ('orientation', 'i1', (H, W, 8)),  # occlusion orientations in {-1, 0, 1}
+                     ('normal', '<u2', (H, W, 3)),  # 16-bit normal in BGR order
+                     ('img', 'u1', (H, W, 3))])  # 8-bit image in BGR order
+
+
+class InteriorNetShards(InteriorNet):
+    """
+    InteriorNet samples packed by data/pack_interior_net.py into a few contiguous shard files.
+    Shards are memory-mapped once per process and samples are read by offset.
+    The shards must have been packed from the given label_name and method_name, None skips the check.
+    """
+    def __init__(self, shard_dir, label_name=None, method_name=None, index_file='index.json'):
+        data.Dataset.__init__(self)
+        self.shard_dir = shard_dir
+        with open(join(shard_dir, index_file)) as f:
+            self.index = json.load(f)
+        for key, expected in [('label_name', label_name), ('method_name', method_name)]:
+            if expected is not None and self.index[key] != expected:
+                raise ValueError('shards in {} were packed with {} {}, expected {}'.format(
+                    shard_dir, key, self.index[key], expected))
+        self.label_name = self.index['label_name']
+        self.method_name = self.index['method_name']
+        self.dtype = shard_dtype(self.index['height'], self.index['width'])
+        self.shard_files = [shard['file'] for shard in self.index['shards']]
+        self.shard_offsets = np.cumsum([0] + [shard['num_samples'] for shard in self.index['shards']])
+        self._shards = dict()
+
+    def __len__(self):
+        return int(self.shard_offsets[-1])
+
+    def __getstate__(self):
+        # memory maps are reopened by each data loading worker
+        state = self.__dict__.copy()
+        state['_shards'] = dict()
+        return state
+
+    def _fetch_raw(self, index):
+        shard_id = int(np.searchsorted(self.shard_offsets, index, side='right')) - 1
+        if shard_id not in self._shards:
+            shard = np.load(join(self.shard_dir, self.shard_files[shard_id]), mmap_mode='r')
+            if shard.dtype != self.dtype:
+                raise ValueError('{} was packed in another format, run data/pack_interior_net.py again'.format(
+                    self.shard_files[shard_id]))
+            self._shards[shard_id] = shard
+        record = self._shards[shard_id][index - self.shard_offsets[shard_id]]
+
+        label = np.empty(record['score'].shape + (9,), np.float32)
+        label[:, :, 0] = record['score']
+        label[:, :, 1:] = record['orientation']
+        return record['depth_gt'], np.array(record['depth_pred']), label, record['normal'], record['img']
+
+
 if __name__ == "__main__":
     root_dir = '/space_sdd/InteriorNet'
     dataset = InteriorNet(root_dir)
@@ -0,0 +1,73 @@
+import os
+from os.path import join
+import torch
+import numpy as np
+import cv2
+
+import torch.utils.data as data
+
+from lib.utils.data_utils import padding_array, load_occlusion_label
+
+
+class NYUv2(data.Dataset):
+    """
+    Occlusion and auxiliary inputs of the NYUv2 validation set, paired with coarse depth predictions.
+    Each item is (index, depth, occlusion, aux); aux is an empty tensor when aux_type is None.
+    depths is either an array of (N, H, W) depth maps, giving a (1, H, W) depth per item, or a dict of
+    such arrays keyed by method, giving a (M, 1, H, W) depth per item so that all methods share one load
+    of the occlusion and aux inputs.
+    """
+    def __init__(self, occ_dir, data_dir, depths, th=None, aux_type=None,
+                 occ_ext='.npy', normal_ext='-normal.png', im_ext='-rgb.png'):
+        super(NYUv2, self).__init__()
+        assert aux_type in [None, 'normal', 'img'], 'unknown auxiliary input {}'.format(aux_type)
+        self.occ_dir = occ_dir
+        self.data_dir = data_dir
+        self.depths = depths
+        self.methods = list(depths.keys()) if isinstance(depths, dict) else None
+        self.th = th
+        self.aux_type = aux_type
+
+        self.occ_list = sorted([name for name in os.listdir(occ_dir) if name.endswith(occ_ext)])
+        self.normal_list = sorted([name for name in os.listdir(data_dir) if name.endswith(normal_ext)])
+        self.img_list = sorted([name for name in os.listdir(data_dir) if name.endswith(im_ext)])
+        self.im_names = [name.split('-')[0] for name in self.occ_list]
+
+        for method_depths in (depths.values() if self.methods is not None else [depths]):
+            assert len(self.occ_list) == len(method_depths), 'depth maps and occlusion maps does not match in quantity!'
+        if aux_type == 'normal':
+            assert len(self.normal_list) == len(self.occ_list), 'normal maps and occlusion maps does not match in quantity!'
+        if aux_type == 'img':
+            assert len(self.img_list) == len(self.occ_list), 'rgb images and occlusion maps does not match in quantity!'
+
+    def __len__(self):
+        return len(self.occ_list)
+
+    def __getitem__(self, index):
+        depth, occlusion, aux = self._fetch_data(index)
+
+        depth = torch.from_numpy(np.ascontiguousarray(depth)).float()
+        depth = depth.unsqueeze(1) if self.methods is not None else depth.unsqueeze(0)
+        occlusion = padding_array(occlusion)
+        aux = padding_array(aux) if aux is not None else torch.zeros(0)
+
+        return index, depth, occlusion, aux
+
+    def _fetch_data(self, index):
+        if self.methods is not None:
+            depth = np.stack([self.depths[method][index] for method in self.methods])
+        else:
+            depth = np.array(self.depths[index], dtype=np.float32)
+
+        # fetch occlusion orientation labels and remove predictions with small score
+        occlusion = load_occlusion_label(join(self.occ_dir, self.occ_list[index]), self.th)
+
+        # fetch normal map or rgb image
+        if self.aux_type == 'normal':
+            aux = cv2.imread(join(self.data_dir, self.normal_list[index]), -1) / (2 ** 16 - 1) * 2 - 1
+        elif self.aux_type == 'img':
+            aux = cv2.imread(join(self.data_dir, self.img_list[index]), -1) / 255
+        else:
+            aux = None
+
+        return depth, occlusion, aux
@@ -0,0 +1,71 @@
+import atexit
+from multiprocessing import Pool
+
+from lib.utils.evaluate_ibims_error_metrics import compute_depth_boundary_error, GtDistanceCache
+from lib.utils.metrics import MetricsAccumulator, BOUNDARY_ERRORS
+
+# ground truth distance caches of the current process keyed by folder
+_GT_DISTANCE_CACHES = dict()
+
+
+def _depth_boundary_error(edges_gt, pred, name=None, gt_cache_dir=None):
+    D_gt, mask_D_gt = None, None
+    if name is not None and gt_cache_dir is not None:
+        if gt_cache_dir not in _GT_DISTANCE_CACHES:
+            _GT_DISTANCE_CACHES[gt_cache_dir] = GtDistanceCache(gt_cache_dir)
+        D_gt, mask_D_gt = _GT_DISTANCE_CACHES[gt_cache_dir].get(name, edges_gt)
+
+    # only the scores are sent back, the estimated edges stay in the worker
+    dbe_acc, dbe_com, _ = compute_depth_boundary_error(edges_gt, pred, D_gt, mask_D_gt)
+    return dbe_acc, dbe_com
+
+
+class AsyncBoundaryEvaluator(object):
+    """
+    Compute depth boundary errors in a pool of worker processes while the network keeps running.
+    Create it before CUDA is initialized so that forked workers stay light, and reuse it across epochs.
+    :param workers: number of worker processes, 0 to compute the errors synchronously
+    :param max_pending: number of images in flight before submit blocks, default to 4 per worker
+    :param gt_cache_dir: folder of the GtDistanceCache, used for images submitted with a name
+    """
+    def __init__(self, workers=4, max_pending=None, gt_cache_dir=None):
+        self.workers = workers
+        self.gt_cache_dir = gt_cache_dir
+        self.max_pending = max_pending if max_pending is not None else 4 * max(workers, 1)
+        self.pool = Pool(workers) if workers > 0 else None
+        self.pending = []
+        self.results = MetricsAccumulator(BOUNDARY_ERRORS)
+
+        # join the workers on exit even if the script stops on an error before closing the evaluator
+        atexit.register(self.close)
+
+    def _add(self, result):
+        dbe_acc, dbe_com = result
+        self.results.update(dbe_acc=dbe_acc, dbe_com=dbe_com)
+
+    def submit(self, edges_gt, pred, name=None):
+        """Queue the depth boundary error of one (H, W) prediction"""
+        args = (edges_gt, pred, name, self.gt_cache_dir)
+        if self.pool is None:
+            self._add(_depth_boundary_error(*args))
+            return
+
+        # bound the queue so that predictions do not pile up in memory
+        while len(self.pending) >= self.max_pending:
+            self._add(self.pending.pop(0).get())
+        self.pending.append(self.pool.apply_async(_depth_boundary_error, args))
+
+    def wait(self, metrics):
+        """Wait for all queued images and merge their errors into the metrics accumulator"""
+        for result in self.pending:
+            self._add(result.get())
+        self.pending = []
+
+        metrics.merge(self.results)
+        self.results = MetricsAccumulator(BOUNDARY_ERRORS)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
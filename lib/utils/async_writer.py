@@ -0,0 +1,53 @@
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncResultWriter(object):
+    """
+    Run result saving functions in background threads so that inference does not wait on encoding and disk.
+    numpy, PIL and cv2 release the GIL while compressing and writing, so threads are enough here.
+    :param workers: number of writer threads, 0 to save synchronously
+    :param max_pending: number of saves in flight before submit blocks, default to 4 per worker
+    """
+    def __init__(self, workers=2, max_pending=None):
+        self.workers = workers
+        max_pending = max_pending if max_pending is not None else 4 * max(workers, 1)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.executor = ThreadPoolExecutor(workers) if workers > 0 else None
+        self.pending = []
+
+        # make sure queued results reach the disk even if the script does not close the writer
+        atexit.register(self.close)
+
+    def _check(self):
+        # drop finished saves and raise the errors of failed ones in the main thread
+        done = [future for future in self.pending if future.done()]
+        self.pending = [future for future in self.pending if not future.done()]
+        for future in done:
+            future.result()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs), the arguments must not be modified by the caller afterwards"""
+        if self.executor is None:
+            fn(*args, **kwargs)
+            return
+
+        self._check()
+        # bound the queue so that results do not pile up in memory when the disk is slower than the network
+        self.slots.acquire()
+        future = self.executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.pending.append(future)
+
+    def flush(self):
+        """Wait for all queued saves"""
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        if self.executor is not None:
+            self.flush()
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,66 @@
+import torch
+
+
+def _valid_mask(gt, pred, mask=None):
+    """Pixels used by the metrics, i.e. non-zero in both gt and pred as in evaluate_ibims_error_metrics"""
+    valid = (gt != 0) & (pred != 0)
+    if mask is not None:
+        valid = valid & (mask != 0)
+    return valid
+
+
+def _masked_mean(x, valid, count):
+    x = x.to(count.dtype)
+    return torch.where(valid, x, torch.zeros_like(x)).flatten(1).sum(1) / count
+
+
+def compute_global_errors_batch(gt, pred, mask=None, dtype=torch.float64):
+    """
+    Batched compute_global_errors on (B, 1, H, W) tensors, computed on the device of the inputs.
+    Pixel-wise errors are computed in the dtype of the inputs and reduced in dtype.
+    :param mask: optional (B, 1, H, W) mask of pixels to evaluate on top of the non-zero ones
+    :return: abs_rel, sq_rel, rmse, log10, thr1, thr2, thr3 as (B,) tensors, nan for images without valid pixels
+    """
+    valid = _valid_mask(gt, pred, mask)
+    count = valid.flatten(1).sum(1).to(dtype)
+
+    # replace invalid pixels by ones so that divisions and logs stay finite
+    gt = torch.where(valid, gt, torch.ones_like(gt))
+    pred = torch.where(valid, pred, torch.ones_like(pred))
+
+    # compute global relative errors
+    thresh = torch.max(gt / pred, pred / gt)
+    thr1 = _masked_mean(thresh < 1.25, valid, count)
+    thr2 = _masked_mean(thresh < 1.25 ** 2, valid, count)
+    thr3 = _masked_mean(thresh < 1.25 ** 3, valid, count)
+
+    diff = gt - pred
+    rmse = _masked_mean(diff ** 2, valid, count).sqrt()
+
+    log10 = _masked_mean((torch.log10((gt + 1e-4).clamp(1e-12, 1e12)) -
+                          torch.log10((pred + 1e-4).clamp(1e-12, 1e12))).abs(), valid, count)
+
+    abs_rel = _masked_mean(diff.abs() / gt, valid, count)
+
+    sq_rel = _masked_mean(diff ** 2 / gt, valid, count)
+
+    return abs_rel, sq_rel, rmse, log10, thr1, thr2, thr3
+
+
+def compute_directed_depth_error_batch(gt, pred, thr, mask=None, dtype=torch.float64):
+    """
+    Batched compute_directed_depth_error on (B, 1, H, W) tensors, computed on the device of the inputs.
+    :return: dde_0, dde_m, dde_p as (B,) tensors
+    """
+    valid = _valid_mask(gt, pred, mask)
+    count = valid.flatten(1).sum(1).to(dtype)
+
+    # depths closer than thr are '1s' and farther ones are '0s'
+    gt_near = gt <= thr
+    pred_near = pred <= thr
+
+    dde_0 = (valid & (gt_near == pred_near)).flatten(1).sum(1).to(dtype) / count
+    dde_m = (valid & pred_near & ~gt_near).flatten(1).sum(1).to(dtype) / count
+    dde_p = (valid & ~pred_near & gt_near).flatten(1).sum(1).to(dtype) / count
+
+    return dde_0, dde_m, dde_p
@@ -1,10 +1,15 @@
+import os
+import abc
+import json
+from collections import OrderedDict
 import numpy as np
 import torch
 import pickle as pkl
 import h5py
 from scipy.io import loadmat
 import cv2
-import gc
+
+from lib.utils.io_utils import atomic_write
 
 
 def neighbor_depth_variation(depth, diagonal=np.sqrt(2)):
@@ -78,85 +83,302 @@ def padding_array(label_crop, h=480, w=640):
     return label
 
 
-# functions to read depth predictions on NYUv2
+# compact storage of the (H, W, 9) occlusion labels, channel 0 is the score and channels 1-8 are in {-1, 0, 1}
+
+def encode_occlusion_label(label, packed=False):
+    """
+    Encode an occlusion label as its score and int8 orientations, or with packed=True
+    as its score and the 8 orientations packed by 2 bits in one uint16 per pixel.
+    The score keeps its precision so that a threshold gives the same mask as on the raw label.
+    """
+    score = np.ascontiguousarray(label[:, :, 0])
+    orientation = np.rint(label[:, :, 1:]).astype(np.int8)
+    assert np.abs(orientation).max() <= 1, 'occlusion orientations should be in {-1, 0, 1}'
+    if not packed:
+        return {'score': score, 'orientation': orientation}
+
+    codes = (orientation + 1).astype(np.uint16)
+    orientation_bits = np.zeros(codes.shape[:2], np.uint16)
+    for k in range(8):
+        orientation_bits |= codes[:, :, k] << (2 * k)
+    return {'score': score, 'orientation_bits': orientation_bits}
+
+
+def save_occlusion_label(path, label, packed=False):
+    """Save an occlusion label in the compact .npz encoding"""
+    np.savez(path, **encode_occlusion_label(label, packed))
+
+
+def load_occlusion_label(path, th=None):
+    """
+    Load an occlusion label saved either as a raw (H, W, 9) .npy array or in the compact .npz encoding
+    and decode it into a (H, W, 9) float32 array. Orientations whose score is not above th are removed.
+    """
+    if not path.endswith('.npz'):
+        label = np.load(path)
+        if th is not None:
+            mask = label[:, :, 0] <= th
+            label[mask, 1:] = 0
+        return label.astype(np.float32)
+
+    with np.load(path) as f:
+        score = f['score']
+        if 'orientation' in f:
+            orientation = f['orientation']
+        else:
+            shifts = np.arange(0, 16, 2, dtype=np.uint16)
+            orientation = ((f['orientation_bits'][:, :, np.newaxis] >> shifts) & 3).astype(np.int8) - 1
+
+    label = np.empty(score.shape + (9,), np.float32)
+    label[:, :, 0] = score
+    label[:, :, 1:] = orientation
+
+    # remove predictions with small score
+    if th is not None:
+        mask = label[:, :, 0] <= th
+        label[mask, 1:] = 0
+    return label
+
+
+# sources of depth predictions on NYUv2
 
 eigen_crop = [0, 480, 0, 640]
 
+# folder of predictions packed into memory-mapped float32 arrays by data/pack_nyu_predictions.py
+PRED_STORE_DIR = '/space_sdd/NYU/depth_predictions/packed'
+
+PRED_DIR = '/space_sdd/NYU/depth_predictions'
+
+
+def packed_prediction_paths(method, store_dir=PRED_STORE_DIR):
+    """Return the paths of the (N, H, W) float32 array and of its index sidecar for a method"""
+    return os.path.join(store_dir, '{}.npy'.format(method)), os.path.join(store_dir, '{}.json'.format(method))
+
+
+def pack_predictions(method, depths, store_dir=PRED_STORE_DIR):
+    """Write the predictions of a method as a single float32 array along with an index sidecar"""
+    array_path, index_path = packed_prediction_paths(method, store_dir)
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    height, width = depths[0].shape
+
+    def write_array(path):
+        packed = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(len(depths), height, width))
+        for i in range(len(depths)):
+            packed[i] = depths[i]
+        packed.flush()
+        del packed
+
+    def write_index(path):
+        index = {'method': method, 'num_images': len(depths), 'height': height, 'width': width, 'dtype': 'float32'}
+        with open(path, 'w') as f:
+            json.dump(index, f, indent=2)
+
+    # the sidecar is written last and marks the pack as complete
+    atomic_write(array_path, write_array)
+    atomic_write(index_path, write_index)
+
+
+def load_packed_predictions(method, store_dir=PRED_STORE_DIR):
+    """Return a read-only (N, H, W) memory-mapped view of the packed predictions of a method"""
+    array_path, index_path = packed_prediction_paths(method, store_dir)
+    with open(index_path) as f:
+        index = json.load(f)
+    depths = np.load(array_path, mmap_mode='r')
+    assert depths.shape == (index['num_images'], index['height'], index['width']), \
+        'packed predictions of {} do not match their index'.format(method)
+    return depths
+
+
+class PredictionSource(abc.ABC):
+    """
+    Lazy sequence of depth predictions in meters, decoded one item at a time.
+    Every item is cropped to crop = [top, bottom, left, right], resized to size = (H, W) if needed and
+    returned as a float32 array. Up to cache_size decoded items are kept in a LRU cache.
+    """
+    def __init__(self, crop=eigen_crop, size=(480, 640), cache_size=0):
+        self.crop = crop
+        self.size = size
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    @abc.abstractmethod
+    def __len__(self):
+        pass
+
+    @abc.abstractmethod
+    def _read(self, index):
+        """Return the raw (H, W) prediction of the given index"""
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('index {} is out of range'.format(index))
+
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+
+        depth = self._read(index)[self.crop[0]:self.crop[1], self.crop[2]:self.crop[3]]
+        depth = np.asarray(depth, dtype=np.float32)
+        if depth.shape != tuple(self.size):
+            depth = cv2.resize(depth, (self.size[1], self.size[0]))
+
+        if self.cache_size > 0:
+            self._cache[index] = depth
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return depth
+
+    def __getstate__(self):
+        # open file handles and cached items are not sent to data loading workers
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        state.pop('_handle', None)
+        state.pop('_handle_pid', None)
+        return state
+
+
+class PackedSource(PredictionSource):
+    """Predictions packed by pack_predictions, read from a memory-mapped array"""
+    def __init__(self, method, store_dir=PRED_STORE_DIR, **kwargs):
+        super(PackedSource, self).__init__(**kwargs)
+        self.depths = load_packed_predictions(method, store_dir)
+
+    def __len__(self):
+        return len(self.depths)
+
+    def _read(self, index):
+        return self.depths[index]
+
+
+class WholeArraySource(PredictionSource):
+    """Predictions stored in a single file, which is decoded as a whole on first access"""
+    def __init__(self, **kwargs):
+        super(WholeArraySource, self).__init__(**kwargs)
+        self._depths = None
+
+    @abc.abstractmethod
+    def _load(self):
+        """Return the array of all predictions"""
+
+    @property
+    def depths(self):
+        if self._depths is None:
+            self._depths = self._load()
+        return self._depths
+
+    def __len__(self):
+        return len(self.depths)
+
+    def _read(self, index):
+        return self.depths[index]
+
+
+PREDICTION_SOURCES = dict()
+
+
+def register_prediction_source(method):
+    """Register a PredictionSource class under the name of its method"""
+    def decorator(cls):
+        PREDICTION_SOURCES[method] = cls
+        return cls
+    return decorator
+
+
+def get_prediction_source(method, store_dir=PRED_STORE_DIR, **kwargs):
+    """
+    Return the lazy source of depth predictions for a method.
+    A pack of the method in store_dir is preferred, which also makes any packed method usable without registering it.
+    """
+    if store_dir is not None and os.path.exists(packed_prediction_paths(method, store_dir)[1]):
+        return PackedSource(method, store_dir, **kwargs)
+    if method not in PREDICTION_SOURCES:
+        raise KeyError('unknown prediction method {}, available ones are {}'.format(
+            method, ', '.join(sorted(PREDICTION_SOURCES))))
+    return PREDICTION_SOURCES[method](**kwargs)
+
+
+@register_prediction_source('jiao')
+class JiaoSource(PredictionSource):
+    def __len__(self):
+        return 654
+
+    def _read(self, index):
+        return loadmat(os.path.join(PRED_DIR, 'jiao_pred_mat', '{}.mat'.format(index + 1)))['pred']
+
+
+@register_prediction_source('laina')
+class LainaSource(PredictionSource):
+    path = os.path.join(PRED_DIR, 'laina_predictions_NYUval.mat')
+
+    def _file(self):
+        # HDF5 handles are not fork-safe, so a handle is opened lazily by each process that reads,
+        # and one inherited from the parent by a forked data loading worker is replaced
+        if getattr(self, '_handle_pid', None) != os.getpid():
+            self._handle = h5py.File(self.path, 'r')
+            self._handle_pid = os.getpid()
+        return self._handle['predictions']
+
+    def __len__(self):
+        # the length is read through a short-lived handle so that none is left open before workers are forked
+        if getattr(self, '_length', None) is None:
+            with h5py.File(self.path, 'r') as f:
+                self._length = f['predictions'].shape[0]
+        return self._length
+
+    def _read(self, index):
+        return np.array(self._file()[index]).T
+
+
+@register_prediction_source('sharpnet')
+class SharpnetSource(WholeArraySource):
+    def _load(self):
+        with open(os.path.join(PRED_DIR, 'sharpnet_prediction.pkl'), 'rb') as f:
+            return np.array(pkl.load(f))
+
+
+@register_prediction_source('eigen')
+class EigenSource(WholeArraySource):
+    def _load(self):
+        # predictions are stored at low resolution and resized to 480x640 on access
+        return loadmat(os.path.join(PRED_DIR, 'eigen_nyud_depth_predictions.mat'))['fine_predictions'].transpose((2, 0, 1))
+
+
+@register_prediction_source('dorn')
+class DornSource(PredictionSource):
+    def __init__(self, **kwargs):
+        super(DornSource, self).__init__(**kwargs)
+        with open(os.path.join(PRED_DIR, 'NYUV2_DORN', 'list_dorn_order.txt'), 'r') as f:
+            self.names = [line.strip() for line in f.readlines()]
+
+    def __len__(self):
+        return len(self.names)
+
+    def _read(self, index):
+        return loadmat(os.path.join(PRED_DIR, 'NYUV2_DORN', 'NYUV2_DORN', self.names[index]))['pred']
+
+
+@register_prediction_source('bts')
+class BtsSource(PredictionSource):
+    def __init__(self, **kwargs):
+        super(BtsSource, self).__init__(**kwargs)
+        with open(os.path.join(PRED_DIR, 'result_bts_nyu', 'pred_bts.txt'), 'r') as f:
+            names = [line.strip() for line in f.readlines()]
+        # sort by the image number at the end of the file name
+        self.names = sorted(names, key=lambda name: int(name[name.rfind('_') + 1:-4]))
+
+    def __len__(self):
+        return len(self.names)
+
+    def _read(self, index):
+        return cv2.imread(os.path.join(PRED_DIR, 'result_bts_nyu', 'raw', self.names[index]), -1) / 1000
+
 
-def read_jiao():
-    ours = []
-    jiao_pred_path = '/space_sdd/NYU/depth_predictions/jiao_pred_mat/'
-    for i in range(654):
-        f = loadmat(jiao_pred_path + str(i+1) + '.mat')
-        f = f['pred']
-        ours.append(f)
-    ours = np.array(ours)
-    return ours
-
-
-def read_laina():
-    laina_pred = h5py.File('/space_sdd/NYU/depth_predictions/laina_predictions_NYUval.mat', 'r')['predictions']
-    laina_pred = np.array(laina_pred).transpose((0, 2, 1))
-    laina_pred = laina_pred[:, eigen_crop[0]:eigen_crop[1], eigen_crop[2]:eigen_crop[3]]
-    return laina_pred
-
-
-def read_sharpnet():
-    with open('/space_sdd/NYU/depth_predictions/sharpnet_prediction.pkl', 'rb') as f:
-        ours = pkl.load(f)
-    ours = np.array(ours)
-    ours = ours[:, eigen_crop[0]:eigen_crop[1], eigen_crop[2]:eigen_crop[3]]
-    return ours
-
-
-def read_eigen():
-    ours = loadmat('/space_sdd/NYU/depth_predictions/eigen_nyud_depth_predictions.mat')
-    ours = ours['fine_predictions']
-    ours = ours.transpose((2, 0, 1))
-    out = []
-    for line in ours:
-        line = cv2.resize(line, (640,480))
-        out.append(line)
-    out = np.array(out)
-    return out
-
-
-def read_dorn():
-    ours = []
-    list_dirs = open('/space_sdd/NYU/depth_predictions/NYUV2_DORN/list_dorn_order.txt', 'r').readlines()
-    for line in list_dirs:
-        line = line.strip()
-        f = loadmat('/space_sdd/NYU/depth_predictions/NYUV2_DORN/NYUV2_DORN/' + line)
-        pred = f['pred'][eigen_crop[0]:eigen_crop[1], eigen_crop[2]:eigen_crop[3]]
-        ours.append(pred)
-    ours = np.array(ours)
-    return ours
-
-
-def read_bts():
-    ours = []
-    list_dirs = open('/space_sdd/NYU/depth_predictions/result_bts_nyu/pred_bts.txt', 'r').readlines()
-    tmp_dict = dict()
-    for line in list_dirs:
-        line = line.strip()
-        num_tmp = line.rfind('_')
-        key = int(line[num_tmp+1:-4])
-        f = cv2.imread('/space_sdd/NYU/depth_predictions/result_bts_nyu/raw/' + line, -1)
-        f = f / 1000
-        pred = f[eigen_crop[0]:eigen_crop[1], eigen_crop[2]:eigen_crop[3]]
-        tmp_dict[key] = pred
-    keys = list(tmp_dict.keys())
-    keys.sort()
-    for key in keys:
-        ours.append(tmp_dict[key])
-    del tmp_dict
-    gc.collect()
-    ours = np.array(ours)
-    return ours
-
-
-def read_vnl():
-    ours = pkl.load(open('/space_sdd/NYU/depth_predictions/pred_VNL.pkl', 'rb'))
-    ours = np.array(ours) * 10
-    ours = ours[:, eigen_crop[0]:eigen_crop[1], eigen_crop[2]:eigen_crop[3]]
-    return ours
+@register_prediction_source('vnl')
+class VnlSource(WholeArraySource):
+    def _load(self):
+        with open(os.path.join(PRED_DIR, 'pred_VNL.pkl'), 'rb') as f:
+            return np.array(pkl.load(f)) * 10
@@ -7,44 +7,75 @@ Remote Sensing Technology, Technical University of Munich
 www.lmf.bgu.tum.de
 """
 
+import os
+import zlib
 import numpy as np
 from skimage import feature
 from scipy import ndimage
-from sklearn.decomposition import PCA
-import math
-import matplotlib.pyplot as plt
-from scipy import ndimage
 
+from lib.utils.io_utils import atomic_write
 
-def compute_distance_related_errors(gt, pred):
-    #initialize output
-    abs_rel_vec_tmp = np.zeros(20, np.float32)
-    log10_vec_tmp   = np.zeros(20, np.float32)
-    rms_vec_tmp     = np.zeros(20, np.float32)
-    
-   
+# back projection factors of the pixel grid keyed by image size and calibration
+_PIXEL_RAYS = dict()
+
+
+def _distance_bin_sums(gt, pred, num_bins=20):
     # exclude masked invalid and missing measurements
     gt = gt[gt != 0]
     pred = pred[pred != 0]
 
-    gt_all = gt
-    pred_all = pred
-    bot = 0.0
-    idx = 0
-
-    for top in range(1, 21):
-        mask = np.logical_and(gt_all >= bot, gt_all <= top)
-        gt_tmp = gt_all[mask]
-        pred_tmp = pred_all[mask]
-        # calc errors
-        abs_rel_vec_tmp[idx], tmp, rms_vec_tmp[idx], log10_vec_tmp[idx], tmp, tmp, tmp = compute_global_errors(
-            gt_tmp, pred_tmp)
-
-        bot = top  # re-assign bottom threshold
-        idx = idx + 1
-     
-    return abs_rel_vec_tmp,log10_vec_tmp,rms_vec_tmp
-        
+    # bin k covers depths in [k, k+1] meters, so depths at integer boundaries count in two bins
+    gt_all = gt[gt <= num_bins].astype(np.float64)
+    pred_all = pred[gt <= num_bins].astype(np.float64)
+    bins = np.maximum(np.ceil(gt_all).astype(int) - 1, 0)
+    upper = (gt_all == np.floor(gt_all)) & (gt_all >= 1) & (gt_all < num_bins)
+    bins = np.concatenate((bins, gt_all[upper].astype(int)))
+    gt_all = np.concatenate((gt_all, gt_all[upper]))
+    pred_all = np.concatenate((pred_all, pred_all[upper]))
+
+    # accumulate errors of all bins in a single pass
+    log_diff = np.abs(np.log10(np.clip(gt_all + 1e-4, a_min=1e-12, a_max=1e12)) -
+                      np.log10(np.clip(pred_all + 1e-4, a_min=1e-12, a_max=1e12)))
+    count = np.bincount(bins, minlength=num_bins)
+    abs_rel_sum = np.bincount(bins, np.abs(gt_all - pred_all) / gt_all, minlength=num_bins)
+    sq_sum = np.bincount(bins, (gt_all - pred_all) ** 2, minlength=num_bins)
+    log10_sum = np.bincount(bins, log_diff, minlength=num_bins)
+    return count, abs_rel_sum, sq_sum, log10_sum
+
+
+def _distance_bin_errors(count, abs_rel_sum, sq_sum, log10_sum):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        abs_rel_vec = (abs_rel_sum / count).astype(np.float32)
+        log10_vec = (log10_sum / count).astype(np.float32)
+        rms_vec = np.sqrt(sq_sum / count).astype(np.float32)
+    return abs_rel_vec, log10_vec, rms_vec
+
+
+def compute_distance_related_errors(gt, pred):
+    # errors of the 20 depth bins of 1 meter, nan for bins without any depth
+    return _distance_bin_errors(*_distance_bin_sums(gt, pred))
+
+
+class DistanceRelatedErrors(object):
+    """
+    Streaming version of compute_distance_related_errors over a dataset.
+    Errors are pooled over the pixels of all images in each bin, no per-image arrays are kept.
+    """
+    def __init__(self, num_bins=20):
+        self.num_bins = num_bins
+        self.sums = [np.zeros(num_bins) for _ in range(4)]
+
+    def update(self, gt, pred):
+        for total, s in zip(self.sums, _distance_bin_sums(gt, pred, self.num_bins)):
+            total += s
+
+    def merge(self, other):
+        for total, s in zip(self.sums, other.sums):
+            total += s
+
+    def result(self):
+        return _distance_bin_errors(*self.sums)
+
 
 def compute_global_errors(gt, pred):
     # exclude masked invalid and missing measurements
@@ -94,7 +125,42 @@ def compute_directed_depth_error(gt, pred, thr):
     return dde_0, dde_m, dde_p
 
 
-def compute_depth_boundary_error(edges_gt, pred):
+def compute_gt_distance(edges_gt, max_dist_thr=10.):
+    # compute distance transform of the ground truth edges, truncated to the local neighborhood
+    D_gt = ndimage.distance_transform_edt(1 - edges_gt)
+    mask_D_gt = D_gt < max_dist_thr
+    D_gt = np.minimum(D_gt, max_dist_thr)
+    return D_gt, mask_D_gt
+
+
+class GtDistanceCache(object):
+    """
+    Truncated distance transforms of ground truth edges and their masks, saved in cache_dir by image name.
+    A checksum of the edges is stored along with them so that a changed ground truth is recomputed.
+    """
+    def __init__(self, cache_dir, max_dist_thr=10.):
+        self.cache_dir = cache_dir
+        self.max_dist_thr = max_dist_thr
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, name, edges_gt):
+        checksum = zlib.crc32(np.ascontiguousarray(edges_gt).tobytes())
+        path = os.path.join(self.cache_dir, '{}.npz'.format(name))
+        if os.path.exists(path):
+            with np.load(path) as f:
+                if int(f['checksum']) == checksum and float(f['max_dist_thr']) == self.max_dist_thr:
+                    return f['dist'], f['mask']
+
+        D_gt, mask_D_gt = compute_gt_distance(edges_gt, self.max_dist_thr)
+        D_gt = D_gt.astype(np.float32)
+        atomic_write(path, lambda tmp_path: np.savez(tmp_path, dist=D_gt, mask=mask_D_gt, checksum=checksum,
+                                                     max_dist_thr=self.max_dist_thr))
+        return D_gt, mask_D_gt
+
+
+def compute_depth_boundary_error(edges_gt, pred, D_gt=None, mask_D_gt=None):
+    # D_gt and mask_D_gt can be precomputed by compute_gt_distance since they only depend on edges_gt
     # skip dbe if there is no ground truth distinct edge
     if np.sum(edges_gt) == 0:
         dbe_acc = np.nan
@@ -111,13 +177,12 @@ def compute_depth_boundary_error(edges_gt, pred):
         # apply canny filter
         edges_est = feature.canny(pred_normalized, sigma=np.sqrt(2), low_threshold=0.15, high_threshold=0.3)
 
-        # compute distance transform for chamfer metric
-        D_gt = ndimage.distance_transform_edt(1 - edges_gt)
-        D_est = ndimage.distance_transform_edt(1 - edges_est)
-
         max_dist_thr = 10.  # Threshold for local neighborhood
 
-        mask_D_gt = D_gt < max_dist_thr  # truncate distance transform map
+        # compute distance transform for chamfer metric
+        if D_gt is None:
+            D_gt, mask_D_gt = compute_gt_distance(edges_gt, max_dist_thr)  # truncate distance transform map
+        D_est = ndimage.distance_transform_edt(1 - edges_est)
 
         E_fin_est_filt = edges_est * mask_D_gt  # compute shortest distance for all predicted edges
 
@@ -139,75 +204,99 @@ def compute_depth_boundary_error(edges_gt, pred):
     return dbe_acc, dbe_com, edges_est
 
 
+def _pixel_rays(shape, calib):
+    # x and z factors of the back projection, built once per image size and calibration
+    key = (shape, calib.tobytes())
+    if key not in _PIXEL_RAYS:
+        fx_d = calib[0, 0]
+        fy_d = calib[1, 1]
+        cx_d = calib[2, 0]
+        cy_d = calib[2, 1]
+        c = np.arange(1, shape[1] + 1, dtype=np.float64)
+        r = np.arange(1, shape[0] + 1, dtype=np.float64)
+        ray_x = np.broadcast_to((c - cx_d) / fx_d, shape)
+        ray_z = np.broadcast_to((-(r - cy_d) / fy_d)[:, None], shape)
+        _PIXEL_RAYS[key] = (ray_x, ray_z)
+    return _PIXEL_RAYS[key]
+
+
+def _grouped_median(values, groups, num_groups):
+    # median of the values of each group, nan for empty groups
+    order = np.lexsort((values, groups))
+    values = values[order]
+    count = np.bincount(groups, minlength=num_groups)
+    start = np.cumsum(count) - count
+    median = np.full(num_groups, np.nan)
+    valid = count > 0
+    lo = start[valid] + (count[valid] - 1) // 2
+    hi = start[valid] + count[valid] // 2
+    median[valid] = (values[lo] + values[hi]) / 2.
+    return median
+
+
 def compute_planarity_error(gt,pred,paras,mask,calib):
     
-    # mask invalid and missing depth values
-    pred[pred==0]=np.nan
-    gt[gt==0]=np.nan
-    
     # number of planes of the current plane type
     nr_planes = paras.shape[0]
-    
-    # initialize PE errors
-    pe_fla = np.empty(0)
-    pe_ori = np.empty(0)
-    
-    for j in range(nr_planes):  #loop over number of planes
-        
-        # only consider depth values for this specific planar mask
-        curr_plane_mask = mask.copy()
-        curr_plane_mask[curr_plane_mask<(j+1)] = 0
-        curr_plane_mask[curr_plane_mask>(j+1)] = 0
-        remain_mask = curr_plane_mask.astype(float)
-        remain_mask[remain_mask==0]=np.nan
-        remain_mask[np.isnan(remain_mask)==0]=1    
-    
-        # only consider plane masks which are bigger than 5% of the image dimension
-        if np.nansum(remain_mask)/(640.*480.)<0.05:
-            flat = np.nan
-            orie = np.nan
-        else:
-           #scale remaining depth map of current plane towards gt depth map
-           mean_depth_est = np.nanmedian(pred*remain_mask)
-           mean_depth_gt  = np.nanmedian(gt*remain_mask)
-           est_depth_scaled = pred/(mean_depth_est/mean_depth_gt)*remain_mask
-           
-           # project masked and scaled depth values to 3D points
-           fx_d = calib[0,0]
-           fy_d = calib[1,1]
-           cx_d = calib[2,0]
-           cy_d = calib[2,1]
-           #c,r = np.meshgrid(range(gt.shape[1]),range(gt.shape[0]))
-           c,r = np.meshgrid(range(1,gt.shape[1]+1),range(1,gt.shape[0]+1))
-           tmp_x = ((c-cx_d)*est_depth_scaled/fx_d) 
-           tmp_y = est_depth_scaled
-           tmp_z = (-(r-cy_d)*est_depth_scaled/fy_d)
-           X = tmp_x.flatten()
-           Y = tmp_y.flatten()
-           Z = tmp_z.flatten()
-           X = X[~np.isnan(X)] 
-           Y = Y[~np.isnan(Y)] 
-           Z = Z[~np.isnan(Z)] 
-           pointCloud = np.stack((X, Y, Z))
-           
-           # fit 3D plane to 3D points (normal, d)
-           pca = PCA(n_components=3)
-           pca.fit(pointCloud.T)
-           normal = -pca.components_[2,:] 
-           point = np.mean(pointCloud,axis=1)
-           d = -np.dot(normal,point);
-           
-           # PE_flat: deviation of fitted 3D plane
-           flat = np.std(np.dot(pointCloud.T,normal.T)+d)*100.
-           
-           n_gt = paras[j,4:7]
-           if np.dot(normal,n_gt)<0:
-               normal = -normal
-           
-           # PE_ori: 3D angle error between ground truth plane and normal vector of fitted plane
-           orie = math.atan2(np.linalg.norm(np.cross(n_gt,normal)),np.dot(n_gt,normal))*180./np.pi 
-        
-        pe_fla = np.append(pe_fla,flat) # append errors
-        pe_ori = np.append(pe_ori,orie)
-           
-    return pe_fla,pe_ori
\ No newline at end of file
+    if nr_planes == 0:
+        return np.empty(0), np.empty(0)
+    gt = gt.astype(np.float64)
+    pred = pred.astype(np.float64)
+
+    # gather the pixels of all planes at once, planes are labelled 1..nr_planes in the mask
+    plane_id = mask.astype(np.int64)
+    in_plane = (plane_id == mask) & (plane_id >= 1) & (plane_id <= nr_planes)
+    plane_size = np.bincount(plane_id[in_plane] - 1, minlength=nr_planes)
+
+    # only consider plane masks which are bigger than 5% of the image dimension
+    large = plane_size / (640. * 480.) >= 0.05
+
+    # mask invalid and missing depth values
+    in_plane &= large[np.clip(plane_id - 1, 0, nr_planes - 1)]
+    pred_sel = in_plane & (pred != 0) & ~np.isnan(pred)
+    gt_sel = in_plane & (gt != 0) & ~np.isnan(gt)
+
+    # scale the depth of each plane towards the gt depth map
+    mean_depth_est = _grouped_median(pred[pred_sel], plane_id[pred_sel] - 1, nr_planes)
+    mean_depth_gt = _grouped_median(gt[gt_sel], plane_id[gt_sel] - 1, nr_planes)
+    ids = plane_id[pred_sel] - 1
+    est_depth_scaled = pred[pred_sel] / (mean_depth_est / mean_depth_gt)[ids]
+
+    # project masked and scaled depth values to 3D points
+    ray_x, ray_z = _pixel_rays(gt.shape, calib)
+    pointCloud = np.stack((ray_x[pred_sel] * est_depth_scaled, est_depth_scaled, ray_z[pred_sel] * est_depth_scaled), 1)
+    valid = ~np.isnan(pointCloud).any(1)
+    pointCloud = pointCloud[valid]
+    ids = ids[valid]
+    nr_points = np.bincount(ids, minlength=nr_planes)
+    fitted = large & (nr_points > 0)
+
+    # fit 3D planes to 3D points (normal, d) with a batched eigendecomposition of the covariances
+    with np.errstate(invalid='ignore', divide='ignore'):
+        point = np.stack([np.bincount(ids, pointCloud[:, k], nr_planes) for k in range(3)], 1) / nr_points[:, None]
+        centered = pointCloud - point[ids]
+        cov = np.empty((nr_planes, 3, 3))
+        for k in range(3):
+            for l in range(k, 3):
+                cov[:, k, l] = cov[:, l, k] = np.bincount(ids, centered[:, k] * centered[:, l], nr_planes) / nr_points
+    cov[~fitted] = np.eye(3)
+    _, eigvec = np.linalg.eigh(cov)
+    normal = eigvec[:, :, 0]
+
+    # PE_flat: deviation of fitted 3D plane
+    dist = np.einsum('ij,ij->i', centered, normal[ids])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dist_mean = np.bincount(ids, dist, nr_planes) / nr_points
+        pe_fla = np.sqrt(np.bincount(ids, (dist - dist_mean[ids]) ** 2, nr_planes) / nr_points) * 100.
+
+    n_gt = paras[:, 4:7].astype(np.float64)
+    dot = np.einsum('ij,ij->i', normal, n_gt)
+    normal[dot < 0] *= -1
+    dot = np.abs(dot)
+
+    # PE_ori: 3D angle error between ground truth plane and normal vector of fitted plane
+    pe_ori = np.arctan2(np.linalg.norm(np.cross(n_gt, normal), axis=1), dot) * 180. / np.pi
+
+    pe_fla[~fitted] = np.nan
+    pe_ori[~fitted] = np.nan
+    return pe_fla,pe_ori
@@ -0,0 +1,22 @@
+import os
+
+
+def atomic_write(path, save_fn):
+    """
+    Write a file through a temporary file next to it, which is moved in place once complete,
+    so that concurrent readers and interrupted runs never see a partial file.
+    The temporary name is unique per process and keeps the extension, which np.save, np.savez and cv2.imwrite use.
+    :param path: path of the file to write
+    :param save_fn: function writing the file to the temporary path given as its only argument
+    :return: the value returned by save_fn
+    """
+    root, ext = os.path.splitext(path)
+    tmp_path = '{}.{}.tmp{}'.format(root, os.getpid(), ext)
+    try:
+        result = save_fn(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return result
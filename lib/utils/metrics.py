@@ -0,0 +1,113 @@
+import os
+import csv
+import json
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+# metrics in the order returned by compute_global_errors_batch and compute_directed_depth_error_batch
+GLOBAL_ERRORS = ('abs_rel', 'sq_rel', 'rms', 'log10', 'thr1', 'thr2', 'thr3')
+BOUNDARY_ERRORS = ('dbe_acc', 'dbe_com')
+DIRECTED_ERRORS = ('dde_0', 'dde_m', 'dde_p')
+METRIC_NAMES = GLOBAL_ERRORS + BOUNDARY_ERRORS + DIRECTED_ERRORS
+
+# metrics of the text report, grouped and ordered as in the training and testing logs
+METRIC_GROUPS = OrderedDict([
+    ('Global Error Metrics', ('abs_rel', 'log10', 'rms', 'thr1', 'thr2', 'thr3')),
+    ('Depth Boundary Error Metrics', BOUNDARY_ERRORS),
+    ('Directed Depth Error Metrics', DIRECTED_ERRORS),
+])
+
+# directed depth errors are reported in percent
+METRIC_SCALES = {'dde_0': 100., 'dde_m': 100., 'dde_p': 100.}
+
+
+class MetricsAccumulator(object):
+    """
+    Running nan-mean of per-image metrics, kept as a sum and a count per metric so memory does not grow
+    with the dataset. Accumulators filled by different workers or processes are combined with merge.
+    :param names: metrics to accumulate, default to METRIC_NAMES
+    """
+    def __init__(self, names=METRIC_NAMES):
+        self.names = tuple(names)
+        self.sums = OrderedDict((name, 0.) for name in self.names)
+        self.counts = OrderedDict((name, 0) for name in self.names)
+
+    def update(self, **values):
+        """Add the per-image values of one or more metrics, given as scalars, arrays or tensors"""
+        for name, value in values.items():
+            if isinstance(value, torch.Tensor):
+                value = value.detach().cpu().numpy()
+            value = np.asarray(value, np.float64).ravel()
+
+            # nan values, e.g. images without valid pixels, are skipped as in np.nanmean
+            valid = ~np.isnan(value)
+            self.sums[name] += value[valid].sum()
+            self.counts[name] += int(valid.sum())
+
+    def update_global(self, errors):
+        """Add the abs_rel, sq_rel, rms, log10, thr1, thr2, thr3 tuple of compute_global_errors_batch"""
+        self.update(**dict(zip(GLOBAL_ERRORS, errors)))
+
+    def update_directed(self, errors):
+        """Add the dde_0, dde_m, dde_p tuple of compute_directed_depth_error_batch"""
+        self.update(**dict(zip(DIRECTED_ERRORS, errors)))
+
+    def merge(self, other):
+        for name in other.names:
+            if name not in self.sums:
+                self.names += (name,)
+                self.sums[name], self.counts[name] = 0., 0
+            self.sums[name] += other.sums[name]
+            self.counts[name] += other.counts[name]
+        return self
+
+    def mean(self, name):
+        if self.counts[name] == 0:
+            return float('nan')
+        return self.sums[name] / self.counts[name] * METRIC_SCALES.get(name, 1.)
+
+    def summary(self):
+        """Mean of every metric over the images seen so far, directed depth errors in percent"""
+        return OrderedDict((name, self.mean(name)) for name in self.names)
+
+    def report(self, precision=3):
+        """
+        Text block of the metrics in the layout of the training and testing logs.
+        :param precision: decimals of the log files, None for the full values printed to stdout
+        """
+        lines = []
+        for group, names in METRIC_GROUPS.items():
+            names = [name for name in names if name in self.sums]
+            if len(names) == 0:
+                continue
+            lines.append('############ {} #################'.format(group))
+            for name in names:
+                label = 'rel' if name == 'abs_rel' else name
+                if precision is None:
+                    lines.append('{:<6} =  {}'.format(label, self.mean(name)))
+                else:
+                    # the log files pad the global errors with one more space than the others
+                    sep = '=  ' if group == 'Global Error Metrics' else '= '
+                    lines.append('{:<6} {}{:.{}f}'.format(label, sep, self.mean(name), precision))
+        return '\n'.join(lines) + '\n'
+
+    def save_json(self, path, **extra):
+        """Write the summary, the number of images per metric and the extra fields to a json file"""
+        summary = OrderedDict(extra)
+        summary['metrics'] = self.summary()
+        summary['counts'] = self.counts
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    def append_csv(self, path, **extra):
+        """Append the summary as one row of a csv file, e.g. one row per epoch given by extra"""
+        row = OrderedDict(extra)
+        row.update(self.summary())
+        write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(row.keys()))
+            if write_header:
+                writer.writeheader()
+            writer.writerow(row)
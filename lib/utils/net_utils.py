@@ -1,9 +1,13 @@
+import contextlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.autograd.function import once_differentiable
+import os
 import numpy as np
-from math import atan, tan, pi
-import itertools
+from math import atan, pi
+
+from lib.utils.io_utils import atomic_write
 
 
 def weights_normal_init(model, dev=0.001):
@@ -42,9 +46,9 @@ def save_checkpoint(state, filename):
     print('save model at {}'.format(filename))
 
 
-def load_checkpoint(model, optimizer, pth_file):
+def load_checkpoint(model, optimizer, pth_file, device='cuda'):
     print("loading checkpoint from {}".format(pth_file))
-    checkpoint = torch.load(pth_file, map_location=lambda storage, loc: storage.cuda())
+    checkpoint = torch.load(pth_file, map_location=torch.device(device))
     epoch = checkpoint['epoch']
     optimizer.load_state_dict(checkpoint['optimizer'])
     pretrained_dict = checkpoint['model']
@@ -56,28 +60,207 @@ def load_checkpoint(model, optimizer, pth_file):
     return epoch
 
 
-def create_gamma_matrix(H=480, W=640, fx=600, fy=600):
+def _physical_cores():
+    # physical cores among the cpus this process may run on, hyper-threads share the vector units of a core
+    cpus = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else range(os.cpu_count())
+    cores = set()
+    for cpu in cpus:
+        topology = '/sys/devices/system/cpu/cpu{}/topology'.format(cpu)
+        try:
+            with open(os.path.join(topology, 'physical_package_id')) as f:
+                package = f.read().strip()
+            with open(os.path.join(topology, 'core_id')) as f:
+                cores.add((package, f.read().strip()))
+        except (IOError, OSError):
+            # no topology information, e.g. outside linux, count every logical cpu
+            return len(cpus)
+    return len(cores)
+
+
+def setup_device(device, num_threads=None, interop_threads=None):
+    """
+    Return the torch device for inference and tune the CPU thread pools when running on CPU.
+    :param num_threads: intra-op threads, default to the number of available physical cores
+    :param interop_threads: inter-op threads, default to 1 since the network runs one graph at a time
+    """
+    device = torch.device(device)
+    if device.type == 'cpu':
+        if num_threads is None:
+            num_threads = _physical_cores()
+        torch.set_num_threads(num_threads)
+        # the inter-op pool can be tuned from torch 1.2
+        if hasattr(torch, 'set_num_interop_threads'):
+            try:
+                torch.set_num_interop_threads(interop_threads if interop_threads is not None else 1)
+            except RuntimeError:
+                # inter-op threads can only be set once, before any parallel work has started
+                pass
+            print('running on cpu with {} intra-op and {} inter-op threads'.format(
+                torch.get_num_threads(), torch.get_num_interop_threads()))
+        else:
+            print('running on cpu with {} threads'.format(torch.get_num_threads()))
+    elif device.type == 'cuda':
+        torch.backends.cudnn.benchmark = True
+    return device
+
+
+def prepare_inference_model(net, device):
+    """Move the network to device in eval mode, using channels_last memory format on CPU from torch 1.5"""
+    net.to(device)
+    if device.type == 'cpu' and hasattr(torch, 'channels_last'):
+        net.to(memory_format=torch.channels_last)
+    net.eval()
+    return net
+
+
+def to_device(tensor, device):
+    """Move an input tensor to device, matching the memory format used by prepare_inference_model"""
+    if tensor is None:
+        return None
+    tensor = tensor.to(device, non_blocking=True)
+    if device.type == 'cpu' and tensor.dim() == 4 and hasattr(torch, 'channels_last'):
+        tensor = tensor.contiguous(memory_format=torch.channels_last)
+    return tensor
+
+
+def synchronize(device):
+    """Wait for pending kernels so that wall-clock timings are accurate"""
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _check_amp(device):
+    # torch.autocast covers CPU and GPU from torch 1.10, torch.cuda.amp covers GPU from torch 1.6
+    if not hasattr(torch, 'autocast') and not (device.type == 'cuda' and hasattr(torch.cuda, 'amp')):
+        raise RuntimeError('mixed precision on {} is not supported by torch {}'.format(device.type, torch.__version__))
+
+
+def autocast(device, enabled=True):
+    """
+    Mixed precision context for the network on device, float16 on GPU and bfloat16 on CPU.
+    When disabled it is a no-op context, which also works with torch versions without autocast.
+    """
+    if not enabled:
+        return contextlib.ExitStack()
+    _check_amp(device)
+    if not hasattr(torch, 'autocast'):
+        return torch.cuda.amp.autocast()
+    dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    return torch.autocast(device.type, dtype=dtype)
+
+
+class _NoGradScaler(object):
+    """Stand-in for GradScaler when gradients are not scaled, e.g. in float32 training"""
+    def scale(self, loss):
+        return loss
+
+    def step(self, optimizer):
+        optimizer.step()
+
+    def update(self):
+        pass
+
+
+def create_grad_scaler(device, enabled=True):
+    """Gradient scaler matching autocast, bfloat16 has the range of float32 so gradients are only scaled on GPU"""
+    if not enabled or device.type != 'cuda':
+        return _NoGradScaler()
+    _check_amp(device)
+    # torch.amp.GradScaler replaces torch.cuda.amp.GradScaler from torch 2.3
+    if hasattr(getattr(torch, 'amp', None), 'GradScaler'):
+        return torch.amp.GradScaler(device.type)
+    return torch.cuda.amp.GradScaler()
+
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        # reset_peak_memory_stats replaces reset_max_memory_allocated from torch 1.4
+        if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+            torch.cuda.reset_peak_memory_stats(device)
+        else:
+            torch.cuda.reset_max_memory_allocated(device)
+
+
+def peak_memory(device):
+    """Peak memory allocated by tensors on device since the last reset in MB, None on CPU where it is not tracked"""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return None
+
+
+# process-wide cache of gamma tables keyed by (H, W, fx, fy, dtype, device)
+_GAMMA_CACHE = {}
+
+# process-wide GradientLoss modules of spatial_gradient_loss keyed by device
+_GRADIENT_LOSSES = {}
+
+# process-wide cache of neighborhood constants keyed by (diagonal, device, dtype)
+_NEIGHBOR_CACHE = {}
+
+# offsets of the neighborhood-8 in the order of the variation channels
+_NEIGHBOR_OFFSETS = [(0, 0), (0, 1), (0, 2), (1, 0), (1, 2), (2, 0), (2, 1), (2, 2)]
+
+
+def _compute_gamma_matrix(H, W, fx, fy):
     fov_x = 2 * atan(W / (2 * fx))
     fov_y = 2 * atan(H / (2 * fy))
-    gamma = np.zeros((H, W, 2))
 
-    for i, j in itertools.product(range(H), range(W)):
-        alpha_x = (pi - fov_x) / 2
-        gamma_x = alpha_x + fov_x * ((W - j) / W)
+    alpha_x = (pi - fov_x) / 2
+    gamma_x = alpha_x + fov_x * ((W - np.arange(W)) / W)
 
-        alpha_y = (pi - fov_y) / 2
-        gamma_y = alpha_y + fov_y * ((H - i) / H)
+    alpha_y = (pi - fov_y) / 2
+    gamma_y = alpha_y + fov_y * ((H - np.arange(H)) / H)
 
-        gamma[i, j, 0] = gamma_x
-        gamma[i, j, 1] = gamma_y
+    gamma = np.empty((H, W, 2))
+    gamma[:, :, 0] = gamma_x[np.newaxis, :]
+    gamma[:, :, 1] = gamma_y[:, np.newaxis]
 
     return gamma
 
 
+def create_gamma_matrix(H=480, W=640, fx=600, fy=600, cache_dir=None):
+    """
+    Compute the (H, W, 2) matrix of viewing angles along x and y for each pixel.
+    The table is cached per process and, if cache_dir is given, as a .npy file on disk.
+    The returned array is shared between callers and thus read-only.
+    """
+    key = (H, W, fx, fy, 'float64', 'numpy')
+    if key in _GAMMA_CACHE:
+        return _GAMMA_CACHE[key]
+
+    gamma = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, 'gamma_{}x{}_fx{}_fy{}.npy'.format(H, W, fx, fy))
+        if os.path.exists(cache_path):
+            gamma = np.load(cache_path)
+        else:
+            gamma = _compute_gamma_matrix(H, W, fx, fy)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            atomic_write(cache_path, lambda path: np.save(path, gamma))
+    if gamma is None:
+        gamma = _compute_gamma_matrix(H, W, fx, fy)
+
+    gamma.setflags(write=False)
+    _GAMMA_CACHE[key] = gamma
+    return gamma
+
+
+def get_gamma_tensor(H=480, W=640, fx=600, fy=600, dtype=torch.float32, device='cpu', cache_dir=None):
+    """Return the gamma matrix as a cached (H, W, 2) tensor of the given dtype on the given device"""
+    device = torch.device(device)
+    key = (H, W, fx, fy, dtype, device)
+    if key not in _GAMMA_CACHE:
+        gamma = create_gamma_matrix(H, W, fx, fy, cache_dir)
+        _GAMMA_CACHE[key] = torch.from_numpy(np.array(gamma)).to(device=device, dtype=dtype)
+    return _GAMMA_CACHE[key]
+
+
 def huber_loss(pred, target, sigma, log=True):
     if log:
-        pred_log = pred.clamp(1e-9).log()
-        target_log = target.clamp(1e-9).log()
+        # logs are taken in float32 under autocast
+        pred_log = pred.float().clamp(1e-9).log()
+        target_log = target.float().clamp(1e-9).log()
         diff_abs = torch.abs(pred_log - target_log)
     else:
         diff_abs = torch.abs(pred - target)
@@ -88,8 +271,9 @@ def huber_loss(pred, target, sigma, log=True):
 
 def berhu_loss(pred, target, log=True):
     if log:
-        pred_log = pred.clamp(1e-9).log()
-        target_log = target.clamp(1e-9).log()
+        # logs are taken in float32 under autocast
+        pred_log = pred.float().clamp(1e-9).log()
+        target_log = target.float().clamp(1e-9).log()
         diff_abs = (pred_log - target_log).abs()
     else:
         diff_abs = (pred - target).abs()
@@ -98,56 +282,104 @@ def berhu_loss(pred, target, log=True):
     return loss.mean()
 
 
-def spatial_gradient_loss(pred, target, mask):
-    sobel_x = torch.as_tensor([[1, 0, -1],
-                               [2, 0, -2],
-                               [1, 0, -1]])
-
-    sobel_x = sobel_x.view((1, 1, 3, 3)).type_as(pred)
-
-    sobel_y = torch.as_tensor([[1, 2, 1],
-                               [0, 0, 0],
-                               [-1, -2, -1]])
-
-    sobel_y = sobel_y.view((1, 1, 3, 3)).type_as(pred)
-
-    pred_log = pred.clamp(1e-7).log()
-    target_log = target.clamp(1e-7).log()
-
-    diff = (pred_log - target_log) * mask
-
-    gx_diff = F.conv2d(diff, (1.0 / 8.0) * sobel_x, padding=1)
-    gy_diff = F.conv2d(diff, (1.0 / 8.0) * sobel_y, padding=1)
+class GradientLoss(nn.Module):
+    """
+    Gradient loss on log depths against one or more targets, with the x and y Sobel filters kept as a buffer
+    and stacked into a single 2-output convolution. The gradients of the prediction are computed once and
+    shared by all targets, and all maps go through one convolution call.
+    """
+    def __init__(self):
+        super(GradientLoss, self).__init__()
+        sobel_x = torch.as_tensor([[1, 0, -1],
+                                   [2, 0, -2],
+                                   [1, 0, -1]], dtype=torch.float32)
+        sobel_y = sobel_x.t()
+        # (2, 1, 3, 3) kernel
+        self.register_buffer('sobel', torch.stack((sobel_x, sobel_y)).unsqueeze(1) / 8.)
+
+    @staticmethod
+    def log(depth):
+        # logs are taken in float32 under autocast
+        return depth.float().clamp(1e-7).log()
+
+    def forward(self, pred, targets, mask):
+        """
+        :param pred: (B, 1, H, W) predicted depth
+        :param targets: (B, 1, H, W) target depth, or a list of them
+        :param mask: (B, 1, H, W) weights of the log depth differences
+        :return: the loss, or the list of losses of the targets
+        """
+        single = torch.is_tensor(targets)
+        targets = [targets] if single else list(targets)
+        losses = self.from_logs(self.log(pred), [self.log(target) for target in targets], mask)
+        return losses[0] if single else losses
+
+    def from_logs(self, pred_log, target_logs, mask):
+        """Losses of the list of target log depths, for callers sharing the logs with other losses"""
+        diffs = [(pred_log - target_log) * mask for target_log in target_logs]
+
+        # squared gradient magnitudes of the prediction, the differences and the targets in one pass
+        maps = torch.cat([pred_log] + diffs + target_logs, 0)
+        gradients = F.conv2d(maps, self.sobel, padding=1).pow(2).sum(1, keepdim=True)
+        gradients = gradients.split(pred_log.shape[0])
+
+        n = len(target_logs)
+        gradients_input = gradients[0]
+        return [gradients_diff.mean() + huber_loss(gradients_input, gradients_target, 3, False)
+                for gradients_diff, gradients_target in zip(gradients[1:n + 1], gradients[n + 1:])]
 
-    gradients_diff = torch.pow(gx_diff, 2) + torch.pow(gy_diff, 2)
-    smooth_loss = gradients_diff.mean()
 
-    gx_input = F.conv2d(pred_log, (1.0 / 8.0) * sobel_x, padding=1)
-    gy_input = F.conv2d(pred_log, (1.0 / 8.0) * sobel_y, padding=1)
+def spatial_gradient_loss(pred, target, mask):
+    if pred.device not in _GRADIENT_LOSSES:
+        _GRADIENT_LOSSES[pred.device] = GradientLoss().to(pred.device)
+    return _GRADIENT_LOSSES[pred.device](pred, target, mask)
 
-    gx_target = F.conv2d(target_log, (1.0 / 8.0) * sobel_x, padding=1)
-    gy_target = F.conv2d(target_log, (1.0 / 8.0) * sobel_y, padding=1)
 
-    gradients_input = torch.pow(gx_input, 2) + torch.pow(gy_input, 2)
-    gradients_target = torch.pow(gx_target, 2) + torch.pow(gy_target, 2)
+def _neighbor_distance(diagonal, device, dtype):
+    """Distances to the neighborhood-8 as a (8, 1, 1, 1) tensor"""
+    key = (float(diagonal), device, dtype)
+    if key not in _NEIGHBOR_CACHE:
+        distance = [diagonal if i != 1 and j != 1 else 1 for i, j in _NEIGHBOR_OFFSETS]
+        _NEIGHBOR_CACHE[key] = torch.tensor(distance, dtype=dtype, device=device).view(8, 1, 1, 1)
+    return _NEIGHBOR_CACHE[key]
 
-    grad_loss = huber_loss(gradients_input, gradients_target, 3, False)
 
-    return smooth_loss + grad_loss
+class _NeighborDepthVariation(torch.autograd.Function):
+    """
+    Differences to the neighborhood-8 written directly into one (B, 8, C, H-2, W-2) output,
+    with the backward scattering them back instead of autograd keeping eight slices and a cat.
+    """
+    @staticmethod
+    def forward(ctx, depth, diagonal):
+        B, C, H, W = depth.shape
+        center = depth[..., 1:-1, 1:-1]
+        var = depth.new_empty(B, 8, C, H - 2, W - 2)
+        for k, (i, j) in enumerate(_NEIGHBOR_OFFSETS):
+            torch.sub(center, depth[..., i:i + H - 2, j:j + W - 2], out=var[:, k])
+            if i != 1 and j != 1:
+                var[:, k].div_(diagonal)
+        ctx.diagonal = diagonal
+        ctx.shape = depth.shape
+        return var.view(B, 8 * C, H - 2, W - 2)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_var):
+        B, C, H, W = ctx.shape
+        distance = _neighbor_distance(ctx.diagonal, grad_var.device, grad_var.dtype)
+        grad_var = grad_var.reshape(B, 8, C, H - 2, W - 2) / distance
+
+        # each variation adds to the gradient of its center and subtracts from the one of its neighbor
+        grad_depth = grad_var.new_zeros(B, C, H, W)
+        grad_depth[..., 1:-1, 1:-1] = grad_var.sum(1)
+        for k, (i, j) in enumerate(_NEIGHBOR_OFFSETS):
+            grad_depth[..., i:i + H - 2, j:j + W - 2] -= grad_var[:, k]
+        return grad_depth, None
 
 
 def neighbor_depth_variation(depth, diagonal=np.sqrt(2)):
     """Compute the variation of depth values in the neighborhood-8 of each pixel"""
-    var1 = (depth[..., 1:-1, 1:-1] - depth[..., :-2, :-2]) / diagonal
-    var2 = depth[..., 1:-1, 1:-1] - depth[..., :-2, 1:-1]
-    var3 = (depth[..., 1:-1, 1:-1] - depth[..., :-2, 2:]) / diagonal
-    var4 = depth[..., 1:-1, 1:-1] - depth[..., 1:-1, :-2]
-    var6 = depth[..., 1:-1, 1:-1] - depth[..., 1:-1, 2:]
-    var7 = (depth[..., 1:-1, 1:-1] - depth[..., 2:, :-2]) / diagonal
-    var8 = depth[..., 1:-1, 1:-1] - depth[..., 2:, 1:-1]
-    var9 = (depth[..., 1:-1, 1:-1] - depth[..., 2:, 2:]) / diagonal
-    
-    return torch.cat((var1, var2, var3, var4, var6, var7, var8, var9), 1)
+    return _NeighborDepthVariation.apply(depth, diagonal)
 
 
 def compute_tangent_adjusted_depth(depth_p, normal_p, depth_q, normal_q, eps=1e-3):
@@ -164,28 +396,131 @@ def compute_tangent_adjusted_depth(depth_p, normal_p, depth_q, normal_q, eps=1e-
     return depth_p_tangent - depth_q_tangent
 
 
-def neighbor_depth_variation_tangent(depth, normal, diagonal=np.sqrt(2)):
-    """Compute the variation of tangent-adjusted depth values in the neighborhood-8 of each pixel"""
-    depth_crop = depth[..., 1:-1, 1:-1]
-    normal_crop = normal[..., 1:-1, 1:-1]
-    var1 = compute_tangent_adjusted_depth(
-        depth_crop, normal_crop, depth[..., :-2, :-2], normal[..., :-2, :-2]) / diagonal
-    var2 = compute_tangent_adjusted_depth(
-        depth_crop, normal_crop, depth[..., :-2, 1:-1], normal[..., :-2, 1:-1])
-    var3 = compute_tangent_adjusted_depth(
-        depth_crop, normal_crop, depth[..., :-2, 2:], normal[..., :-2, 2:]) / diagonal
-    var4 = compute_tangent_adjusted_depth(
-        depth_crop, normal_crop, depth[..., 1:-1, :-2], normal[..., 1:-1, :-2])
-    var6 = compute_tangent_adjusted_depth(
-        depth_crop, normal_crop, depth[..., 1:-1, 2:], normal[..., 1:-1, 2:])
-    var7 = compute_tangent_adjusted_depth(
-        depth_crop, normal_crop, depth[..., 2:, :-2], normal[..., 2:, :-2]) / diagonal
-    var8 = compute_tangent_adjusted_depth(
-        depth_crop, normal_crop, depth[..., 2:, 1:-1], normal[..., 2:, 1:-1])
-    var9 = compute_tangent_adjusted_depth(
-        depth_crop, normal_crop, depth[..., 2:, 2:], normal[..., 2:, 2:]) / diagonal
-    
-    return torch.cat((var1, var2, var3, var4, var6, var7, var8, var9), 1)
+def _channel_dot(x, y):
+    """Sum over the channels of x * y as a (B, H, W) map, accumulated without building the (B, C, H, W) product"""
+    out = x[:, 0] * y[:, 0]
+    for c in range(1, x.shape[1]):
+        out.addcmul_(x[:, c], y[:, c])
+    return out
+
+
+def _tangent_terms(depth_p, normal2_p, norm_p, depth_q, normal2_q, norm_q, eps):
+    """
+    Middle point m of p and q and the terms of compute_tangent_adjusted_depth on (B, H-2, W-2) maps,
+    with the channel norms taken as square roots of sums of squares on every device
+    """
+    depth_m = (depth_p + depth_q).mul_(0.5)
+    depth_m2 = depth_m * depth_m
+    norm_m = depth_m2.sum(1).sqrt_()
+    norm_mp = _channel_dot(depth_m2, normal2_p).sqrt_()
+    norm_mq = _channel_dot(depth_m2, normal2_q).sqrt_()
+    ratio_p = (norm_mp + eps).reciprocal_().mul_(norm_p)
+    ratio_q = (norm_mq + eps).reciprocal_().mul_(norm_q)
+    return depth_m, depth_m2, norm_m, norm_mp, norm_mq, ratio_p, ratio_q
+
+
+class _NeighborDepthVariationTangent(torch.autograd.Function):
+    """
+    Tangent-adjusted differences to the neighborhood-8 computed one neighbor at a time from shifted views,
+    so that only (B, C, H-2, W-2) temporaries of the 8 real neighbors are built and the center is skipped.
+    The backward recomputes them from the inputs instead of autograd keeping every intermediate.
+    """
+    @staticmethod
+    def forward(ctx, depth, normal, diagonal, eps):
+        B, C, H, W = depth.shape
+        normal2 = normal * normal
+        norm = _channel_dot(depth * depth, normal2).sqrt_()
+        center = (depth[..., 1:-1, 1:-1], normal2[..., 1:-1, 1:-1], norm[..., 1:-1, 1:-1])
+
+        var = depth.new_empty(B, 8, H - 2, W - 2)
+        for k, (i, j) in enumerate(_NEIGHBOR_OFFSETS):
+            q = (Ellipsis, slice(i, i + H - 2), slice(j, j + W - 2))
+            _, _, norm_m, _, _, ratio_p, ratio_q = _tangent_terms(*(center + (depth[q], normal2[q], norm[q], eps)))
+            torch.mul(norm_m, ratio_p.sub_(ratio_q), out=var[:, k])
+            if i != 1 and j != 1:
+                var[:, k].div_(diagonal)
+        ctx.save_for_backward(depth, normal)
+        ctx.diagonal = diagonal
+        ctx.eps = eps
+        return var
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_var):
+        depth, normal = ctx.saved_tensors
+        B, C, H, W = depth.shape
+        normal2 = normal * normal
+        depth2 = depth * depth
+        norm = _channel_dot(depth2, normal2).sqrt_()
+        center = (depth[..., 1:-1, 1:-1], normal2[..., 1:-1, 1:-1], norm[..., 1:-1, 1:-1])
+        distance = _neighbor_distance(ctx.diagonal, grad_var.device, grad_var.dtype)
+        grad_var = grad_var / distance.view(1, 8, 1, 1)
+
+        grad_depth = torch.zeros_like(depth)
+        grad_normal2 = torch.zeros_like(normal)
+        grad_norm = torch.zeros_like(norm)
+        for k, (i, j) in enumerate(_NEIGHBOR_OFFSETS):
+            q = (Ellipsis, slice(i, i + H - 2), slice(j, j + W - 2))
+            depth_m, depth_m2, norm_m, norm_mp, norm_mq, ratio_p, ratio_q = _tangent_terms(
+                *(center + (depth[q], normal2[q], norm[q], ctx.eps)))
+            grad = grad_var[:, k]
+
+            # derivatives of norm_m * (ratio_p - ratio_q) w.r.t. the norms of p and q and the squared norms
+            # of m, m * normal_p and m * normal_q, the clamps only matter where the numerators vanish too
+            grad_p = (norm_mp + ctx.eps).reciprocal_().mul_(norm_m).mul_(grad)
+            grad_q = (norm_mq + ctx.eps).reciprocal_().mul_(norm_m).mul_(grad)
+            grad_norm[..., 1:-1, 1:-1] += grad_p
+            grad_norm[q] -= grad_q
+            grad_m2 = (ratio_p - ratio_q).mul_(grad).div_(norm_m.clamp_(min=1e-20).mul_(2))
+            grad_mp2 = grad_p.mul_(ratio_p).div_(norm_mp.clamp_(min=1e-20).mul_(-2))
+            grad_mq2 = grad_q.mul_(ratio_q).div_(norm_mq.clamp_(min=1e-20).mul_(2))
+            grad_mp2, grad_mq2, grad_m2 = grad_mp2.unsqueeze(1), grad_mq2.unsqueeze(1), grad_m2.unsqueeze(1)
+
+            # m is the mean of p and q, so both get half of the derivative w.r.t. m
+            grad_m = torch.addcmul(grad_m2, center[1], grad_mp2).addcmul_(normal2[q], grad_mq2).mul_(depth_m)
+            grad_depth[..., 1:-1, 1:-1] += grad_m
+            grad_depth[q] += grad_m
+            grad_normal2[..., 1:-1, 1:-1].addcmul_(depth_m2, grad_mp2)
+            grad_normal2[q].addcmul_(depth_m2, grad_mq2)
+
+        # norms of depth * normal at p and q
+        grad_norm = grad_norm.div_(norm.clamp_(min=1e-20).mul_(2)).unsqueeze(1)
+        grad_depth.addcmul_(depth, normal2.mul_(grad_norm).mul_(2))
+        grad_normal2.addcmul_(depth2, grad_norm)
+        return grad_depth, grad_normal2.mul_(normal).mul_(2), None, None
+
+
+def neighbor_depth_variation_tangent(depth, normal, diagonal=np.sqrt(2), eps=1e-3):
+    """
+    Compute the variation of tangent-adjusted depth values in the neighborhood-8 of each pixel.
+    Batched version of compute_tangent_adjusted_depth over all neighbors, in float32 under autocast.
+    """
+    dtype = torch.float64 if depth.dtype == torch.float64 else torch.float32
+    return _NeighborDepthVariationTangent.apply(depth.to(dtype), normal.to(dtype), diagonal, eps)
+
+
+def _masked_berhu_loss(pred_log, target_log, mask):
+    """
+    berhu_loss(pred[mask], target[mask]) on log depths, computed densely with the mask as weights
+    so that no boolean gather or host sync is needed. An empty mask gives a zero loss.
+    """
+    mask = mask.to(pred_log.dtype)
+    diff_abs = (pred_log - target_log).abs()
+    delta = 0.2 * (diff_abs * mask).max()
+    loss = torch.where(diff_abs < delta, diff_abs, (diff_abs ** 2 + delta ** 2) / (2 * delta + 1e-9))
+    return (loss * mask).sum() / mask.sum().clamp(min=1)
+
+
+def point_depth(depth, gamma_tan):
+    """
+    Change a plane2plane depth map to a point2point depth map
+    :param depth: (B, 1, H, W)
+    :param gamma_tan: (H, W, 2) tangent of the gamma viewing angles
+    :return: (B, 3, H, W)
+    """
+    delta_x = depth / gamma_tan[:, :, 0]
+    delta_y = depth / gamma_tan[:, :, 1]
+    return torch.cat((delta_x, delta_y, depth), 1)
 
 
 def occlusion_aware_loss(depth_pred, occlusion, normal, gamma, th=1., diagonal=np.sqrt(2), var=0):
@@ -196,42 +531,127 @@ def occlusion_aware_loss(depth_pred, occlusion, normal, gamma, th=1., diagonal=n
     :param normal: (B, 3, H, W)
     :param gamma: (H, W, 2)
     """
-    # change plane2plane depth map to point2point depth map
-    delta_x = depth_pred / gamma[:, :, 0].tan()
-    delta_y = depth_pred / gamma[:, :, 1].tan()
-    depth_point = torch.cat((delta_x, delta_y, depth_pred), 1)
+    # change plane2plane depth map to point2point depth map, in float32 under autocast
+    depth_point = point_depth(depth_pred.float(), gamma.float().tan())
+    return _occlusion_aware_loss(depth_point, occlusion, normal, th, diagonal, var)
 
+
+def _occlusion_aware_loss(depth_point, occlusion, normal, th, diagonal, var):
+    """occlusion_aware_loss on the (B, 3, H, W) point2point depth map"""
     # get neighborhood depth variation in (B, 8, H-2, W-2)
     depth_point_norm = depth_point.norm(dim=1, keepdim=True)
     depth_var_point = neighbor_depth_variation(depth_point_norm, diagonal)
 
-    # get corrected neighborhood depth variation in (B, 8, H-2, W-2)
-    depth_var_tangent = neighbor_depth_variation_tangent(depth_point, normal, diagonal)
-    depth_var_min = torch.min(depth_var_tangent, depth_var_point)
-    depth_var_geo = torch.where(depth_var_tangent > 0, depth_var_min, depth_var_point)
+    # get corrected neighborhood depth variation in (B, 8, H-2, W-2), not needed when only dd is used
+    if var == 1:  ## dd
+        depth_var_geo = depth_var_point
+    else:
+        depth_var_tangent = neighbor_depth_variation_tangent(depth_point, normal, diagonal)
+        depth_var_min = torch.min(depth_var_tangent, depth_var_point)
+        depth_var_geo = torch.where(depth_var_tangent > 0, depth_var_min, depth_var_point)
+        if var == 2:  ## DD
+            depth_var_point = depth_var_geo
 
     # get masks in (B, 8, H-2, W-2)
     orientation = occlusion[:, 1:, 1:-1, 1:-1]
 
-    # compute the loss for different cases
-    th_tensor = torch.as_tensor(th).repeat(depth_var_geo.shape).type_as(depth_var_geo)
-
-    if var == 1:  ## dd
-        depth_var_geo = depth_var_point
-    elif var == 2:  ## DD
-        depth_var_point = depth_var_geo
+    fn_fg_mask = (orientation == 1) & (depth_var_point > -th)
+    fn_bg_mask = (orientation == -1) & (depth_var_point < th)
+    fp_fg_mask = (orientation != 1) & (depth_var_geo < -th)
+    fp_bg_mask = (orientation != -1) & (depth_var_geo > th)
 
-    fn_fg_mask = ((orientation == 1) * (depth_var_point > -th)).float()
-    fn_bg_mask = ((orientation == -1) * (depth_var_point < th)).float()
-    fp_fg_mask = ((orientation != 1) * (depth_var_geo < -th)).float()
-    fp_bg_mask = ((orientation != -1) * (depth_var_geo > th)).float()
+    # compute the loss for different cases, the logs of berhu_loss are shared by the terms of each variation
+    point_log = depth_var_point.clamp(1e-9).log()
+    geo_log = point_log if depth_var_geo is depth_var_point else depth_var_geo.clamp(1e-9).log()
+    fg_log = float(np.log(max(-th, 1e-9)))
+    bg_log = float(np.log(max(th, 1e-9)))
 
-    fn_fg_loss = berhu_loss(depth_var_point[fn_fg_mask != 0], -th_tensor[fn_fg_mask != 0])
-    fn_bg_loss = berhu_loss(depth_var_point[fn_bg_mask != 0], th_tensor[fn_bg_mask != 0])
-    fp_fg_loss = berhu_loss(depth_var_geo[fp_fg_mask != 0], -th_tensor[fp_fg_mask != 0])
-    fp_bg_loss = berhu_loss(depth_var_geo[fp_bg_mask != 0], th_tensor[fp_bg_mask != 0])
+    fn_fg_loss = _masked_berhu_loss(point_log, fg_log, fn_fg_mask)
+    fn_bg_loss = _masked_berhu_loss(point_log, bg_log, fn_bg_mask)
+    fp_fg_loss = _masked_berhu_loss(geo_log, fg_log, fp_fg_mask)
+    fp_bg_loss = _masked_berhu_loss(geo_log, bg_log, fp_bg_mask)
 
     loss_avg = fn_fg_loss + fn_bg_loss + fp_fg_loss + fp_bg_loss
 
     return loss_avg
 
+
+class RefinementLoss(nn.Module):
+    """
+    Training loss of the refinement network, the weighted sum of
+        depth_gt: berhu and gradient losses against the ground truth depth
+        occ: occlusion_aware_loss of the refined depth
+        change: berhu and gradient losses against the coarse depth
+    The float32 log depths are computed once and shared by the berhu and gradient losses, the tangent of gamma
+    is kept between calls, and terms with a zero weight are not computed.
+    :param th: depth discontinuity threshold of the occlusion loss
+    :param diagonal: distance of the diagonal neighbors in the occlusion loss
+    :param var: variation used by the occlusion loss, 0 for both, 1 for dd only, 2 for DD only
+    :param mask_contour: whether to mask the occlusion contours in the gradient losses
+    """
+    def __init__(self, th=15. / 1000, diagonal=np.sqrt(2), var=0, alpha_depth=1., alpha_occ=1., alpha_change=0.,
+                 mask_contour=False):
+        super(RefinementLoss, self).__init__()
+        self.th = th
+        self.diagonal = diagonal
+        self.var = var
+        self.alpha_depth = alpha_depth
+        self.alpha_occ = alpha_occ
+        self.alpha_change = alpha_change
+        self.mask_contour = mask_contour
+        self.gradient_loss = GradientLoss()
+        self._gamma = None
+        self._gamma_tan = None
+
+    def _get_gamma_tan(self, gamma):
+        # gamma is the same table at every step, recompute only when another one is given
+        if gamma is not self._gamma:
+            self._gamma = gamma
+            self._gamma_tan = gamma.float().tan()
+        return self._gamma_tan
+
+    def forward(self, refined, gt, coarse, occlusion, normal, gamma):
+        """
+        :param refined: (B, 1, H, W) refined depth
+        :param gt: (B, 1, H, W) ground truth depth
+        :param coarse: (B, 1, H, W) coarse depth given to the network
+        :param occlusion: (B, 9, H, W)
+        :param normal: (B, 3, H, W)
+        :param gamma: (H, W, 2)
+        :return: weighted total loss and the dict of unweighted depth_gt, occ and change losses
+        """
+        # in float32 under autocast
+        refined = refined.float()
+        zero = refined.new_zeros(())
+
+        if self.mask_contour:
+            mask = (occlusion[:, 0, :, :] == 0).float().unsqueeze(1)
+        else:
+            mask = (occlusion[:, 0, :, :] >= 0).float().unsqueeze(1)
+
+        # berhu_loss clamps depths at 1e-9 and the gradient loss at 1e-7, the latter is a clamp of the same logs
+        grad_log_min = float(np.log(1e-7))
+        refined_log = refined.clamp(1e-9).log()
+        targets = [(gt, self.alpha_depth), (coarse, self.alpha_change)]
+        target_logs = [target.float().clamp(1e-9).log() for target, alpha in targets if alpha != 0]
+        grad_losses = self.gradient_loss.from_logs(refined_log.clamp(grad_log_min),
+                                                   [target_log.clamp(grad_log_min) for target_log in target_logs],
+                                                   mask)
+
+        losses = []
+        for target, alpha in targets:
+            if alpha == 0:
+                losses.append(zero)
+                continue
+            target_log = target_logs.pop(0)
+            losses.append(berhu_loss(refined_log, target_log, log=False) + grad_losses.pop(0))
+        loss_depth_gt, loss_change = losses
+
+        if self.alpha_occ != 0:
+            depth_point = point_depth(refined, self._get_gamma_tan(gamma))
+            loss_occ = _occlusion_aware_loss(depth_point, occlusion, normal, self.th, self.diagonal, self.var)
+        else:
+            loss_occ = zero
+
+        loss = self.alpha_depth * loss_depth_gt + self.alpha_occ * loss_occ + self.alpha_change * loss_change
+        return loss, {'depth_gt': loss_depth_gt, 'occ': loss_occ, 'change': loss_change}
@@ -0,0 +1,64 @@
+import time
+import torch
+
+
+class DevicePrefetcher(object):
+    """
+    Wrap a DataLoader so that the copies of the next batch to the GPU run on a side stream while the
+    current batch is being processed. Create the loader with pin_memory=True for the copies to be asynchronous.
+    On CPU the batches are passed through unchanged.
+    wait_time holds the seconds the last pass spent waiting on the loader, num_batches the number of batches.
+    :param loader: DataLoader yielding lists or tuples of tensors
+    :param device: device the tensors are moved to
+    :param keep_on_host: positions of the batch items to leave on the host, e.g. inputs of CPU metrics
+    """
+    def __init__(self, loader, device, keep_on_host=()):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.keep_on_host = keep_on_host
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.wait_time = 0.
+        self.num_batches = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def _preload(self, iterator):
+        begin = time.time()
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        self.wait_time += time.time() - begin
+
+        if self.stream is None:
+            return batch
+        with torch.cuda.stream(self.stream):
+            return [item.to(self.device, non_blocking=True)
+                    if isinstance(item, torch.Tensor) and k not in self.keep_on_host else item
+                    for k, item in enumerate(batch)]
+
+    def __iter__(self):
+        self.wait_time = 0.
+        self.num_batches = 0
+        iterator = iter(self.loader)
+        next_batch = self._preload(iterator)
+        while next_batch is not None:
+            batch = next_batch
+            if self.stream is not None:
+                # kernels of the current stream must not start before the copies are done,
+                # nor the side stream reuse the memory before these kernels are done
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                for item in batch:
+                    if isinstance(item, torch.Tensor) and item.is_cuda:
+                        item.record_stream(current_stream)
+
+            # issue the copies of the next batch before the work on this one is queued
+            next_batch = self._preload(iterator)
+            self.num_batches += 1
+            yield batch
@@ -1,23 +1,21 @@
 import argparse
 import os
+import time
+import json
+import hashlib
 import numpy as np
-import pickle as pkl
-import h5py
-from scipy.io import loadmat
 from tqdm import tqdm
-import cv2
-import gc
-
-import matplotlib
-matplotlib.use('agg')  # use matplotlib without GUI support
-import matplotlib.pyplot as plt
 
 import torch
+from torch.utils.data import DataLoader, Subset
 import torch.optim as optim
 
 from lib.models.unet import UNet
-from lib.utils.net_utils import load_checkpoint
-from lib.utils.data_utils import padding_array
+from lib.datasets.nyu import NYUv2
+from lib.utils.net_utils import load_checkpoint, setup_device, prepare_inference_model, to_device, synchronize
+from lib.utils.data_utils import get_prediction_source, PRED_STORE_DIR
+from lib.utils.colormap import save_colorized
+from lib.utils.io_utils import atomic_write
 
 # =================PARAMETERS=============================== #
 parser = argparse.ArgumentParser()
@@ -34,168 +32,177 @@ parser.add_argument('--only_contour', action='store_true', help='whether to keep
 parser.add_argument('--th', type=float, default=0.7)
 parser.add_argument('--lr', type=float, default=0.0001, help='learning rate of optimizer')
 
+# device settings
+parser.add_argument('--device', type=str, default='cuda', help='device to run inference on, e.g. cuda, cuda:1 or cpu')
+parser.add_argument('--num_threads', type=int, default=None, help='intra-op threads on cpu, default to the physical cores')
+parser.add_argument('--interop_threads', type=int, default=None, help='inter-op threads on cpu, default to 1')
+parser.add_argument('--batch_size', type=int, default=8,
+                    help='number of images refined at once, each contributes one depth map per method with --single_pass')
+parser.add_argument('--workers', type=int, default=4, help='number of data loading workers')
+parser.add_argument('--single_pass', action='store_true',
+                    help='load occlusion and aux inputs once and refine all methods together')
+
 # pth settings
 parser.add_argument('--result_dir', type=str, default='/space_sdd/NYU/depth_refine')
 parser.add_argument('--occ_dir', type=str, default='/space_sdd/NYU/test_order_nms_pred_pretrain')
+parser.add_argument('--occ_ext', type=str, default='.npy', help='.npy for raw occlusion labels or .npz for compact ones')
+parser.add_argument('--methods', type=str, nargs='+', default=['jiao', 'laina', 'sharpnet', 'eigen', 'dorn', 'bts', 'vnl'],
+                    help='registered or packed prediction methods to refine')
+parser.add_argument('--pred_store', type=str, default=PRED_STORE_DIR,
+                    help='folder of packed depth predictions, methods without a pack are read from the raw files')
 parser.add_argument('--data_dir', type=str, default='/home/xuchong/Projects/occ_edge_order/data/dataset_real/NYUv2/data/val_occ_order_raycasting_woNormal_avgROI_1mm')
+parser.add_argument('--overwrite', action='store_true',
+                    help='refine all images again instead of resuming from the manifest of result_dir')
 
 opt = parser.parse_args()
 print(opt)
 # ========================================================== #
 
 
-# =================CREATE DATASET=========================== #
-eigen_crop = [0, 480, 0, 640]
-
-
-def read_jiao():
-    ours = []
-    jiao_pred_path = '/space_sdd/NYU/depth_predictions/jiao_pred_mat/'
-    for i in range(654):
-        f = loadmat(jiao_pred_path + str(i+1) + '.mat')
-        f = f['pred']
-        ours.append(f)
-    ours = np.array(ours)
-    return ours
-
-
-def read_laina():
-    laina_pred = h5py.File('/space_sdd/NYU/depth_predictions/laina_predictions_NYUval.mat', 'r')['predictions']
-    laina_pred = np.array(laina_pred).transpose((0, 2, 1))
-    laina_pred = laina_pred[:, eigen_crop[0]:eigen_crop[1], eigen_crop[2]:eigen_crop[3]]
-    return laina_pred
-
-
-def read_sharpnet():
-    with open('/space_sdd/NYU/depth_predictions/sharpnet_prediction.pkl', 'rb') as f:
-        ours = pkl.load(f)
-    ours = np.array(ours)
-    ours = ours[:, eigen_crop[0]:eigen_crop[1], eigen_crop[2]:eigen_crop[3]]
-    return ours
-
-
-def read_eigen():
-    ours = loadmat('/space_sdd/NYU/depth_predictions/eigen_nyud_depth_predictions.mat')
-    ours = ours['fine_predictions']
-    ours = ours.transpose((2, 0, 1))
-    out = []
-    for line in ours:
-        line = cv2.resize(line, (640, 480))
-        out.append(line)
-    out = np.array(out)
-    return out
-
-
-def read_dorn():
-    ours = []
-    list_dirs = open('/space_sdd/NYU/depth_predictions/NYUV2_DORN/list_dorn_order.txt', 'r').readlines()
-    for line in list_dirs:
-        line = line.strip()
-        f = loadmat('/space_sdd/NYU/depth_predictions/NYUV2_DORN/NYUV2_DORN/' + line)
-        pred = f['pred'][eigen_crop[0]:eigen_crop[1], eigen_crop[2]:eigen_crop[3]]
-        ours.append(pred)
-    ours = np.array(ours)
-    return ours
-
-
-def read_bts():
-    ours = []
-    list_dirs = open('/space_sdd/NYU/depth_predictions/result_bts_nyu/pred_bts.txt', 'r').readlines()
-    tmp_dict = dict()
-    for line in list_dirs:
-        line = line.strip()
-        num_tmp = line.rfind('_')
-        key = int(line[num_tmp+1:-4])
-        f = cv2.imread('/space_sdd/NYU/depth_predictions/result_bts_nyu/raw/' + line, -1)
-        f = f / 1000
-        pred = f[eigen_crop[0]:eigen_crop[1], eigen_crop[2]:eigen_crop[3]]
-        tmp_dict[key] = pred
-    keys = list(tmp_dict.keys())
-    keys.sort()
-    for key in keys:
-        ours.append(tmp_dict[key])
-    del tmp_dict
-    gc.collect()
-    ours = np.array(ours)
-    return ours
-
-
-def read_vnl():
-    ours = pkl.load(open('/space_sdd/NYU/depth_predictions/pred_VNL.pkl', 'rb'))
-    ours = np.array(ours) * 10
-    ours = ours[:, eigen_crop[0]:eigen_crop[1], eigen_crop[2]:eigen_crop[3]]
-    return ours
-# ========================================================== #
-
-
 # ================CREATE NETWORK AND OPTIMIZER============== #
 net = UNet(use_occ=opt.use_occ, no_contour=opt.no_contour, only_contour=opt.only_contour,
            use_aux=(opt.use_normal or opt.use_img))
 optimizer = optim.Adam(net.parameters(), lr=opt.lr)
 
-load_checkpoint(net, optimizer, opt.checkpoint)
-net.cuda()
-net.eval()
+device = setup_device(opt.device, opt.num_threads, opt.interop_threads)
+load_checkpoint(net, optimizer, opt.checkpoint, device)
+prepare_inference_model(net, device)
 # ========================================================== #
 
 
-# load in occlusion list
-occ_list = sorted([name for name in os.listdir(opt.occ_dir) if name.endswith(".npy")])
-
-# load in normal list
-normal_list = sorted([name for name in os.listdir(opt.data_dir) if name.endswith("-normal.png")])
-
-# load in rgb list
-img_list = sorted([name for name in os.listdir(opt.data_dir) if name.endswith("-rgb.png")])
-
-
-for method in tqdm(['jiao', 'laina', 'sharpnet', 'eigen', 'dorn', 'bts', 'vnl']):
-    # read in depths
-    func = eval('read_{}'.format(method))
-    depths = func()
-    depths = torch.from_numpy(np.ascontiguousarray(depths)).float().unsqueeze(1)
-    assert len(occ_list) == depths.shape[0], 'depth map and occlusion map does not match !'
-
+if opt.use_normal:
+    aux_type = 'normal'
+elif opt.use_img:
+    aux_type = 'img'
+else:
+    aux_type = None
+
+
+def checkpoint_hash(pth_file):
+    sha1 = hashlib.sha1()
+    with open(pth_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def output_names(method, img_name):
+    return [os.path.join(opt.result_dir, method, 'depth_refine', '{}.png'.format(img_name)),
+            os.path.join(opt.result_dir, method, 'depth_init', '{}.png'.format(img_name)),
+            os.path.join(opt.result_dir, method, 'depth_npy', '{}.npy'.format(img_name))]
+
+
+def load_manifest():
+    """(method, image) pairs refined by previous runs with the same checkpoint and threshold"""
+    done = set()
+    if opt.overwrite or not os.path.exists(manifest_path):
+        return done
+
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # last line of an interrupted run
+            if entry['checkpoint'] == run_key['checkpoint'] and entry['th'] == run_key['th']:
+                done.add((entry['method'], entry['image']))
+
+    # outputs removed since then are refined again
+    return set(pair for pair in done if all(os.path.exists(name) for name in output_names(*pair)))
+
+
+def save_outputs(method, img_name, depth_refine, depth_init):
+    refine_name, init_name, save_name = output_names(method, img_name)
+
+    if not os.path.isdir(os.path.dirname(refine_name)):
+        os.makedirs(os.path.dirname(refine_name))
+    if not os.path.isdir(os.path.dirname(init_name)):
+        os.makedirs(os.path.dirname(init_name))
+    if not os.path.isdir(os.path.dirname(save_name)):
+        os.makedirs(os.path.dirname(save_name))
+
+    atomic_write(refine_name, lambda path: save_colorized(path, depth_refine))
+    atomic_write(init_name, lambda path: save_colorized(path, depth_init))
+    atomic_write(save_name, lambda path: np.save(path, depth_refine))
+
+    # record the image once all its outputs are in place
+    entry = dict(run_key, method=method, image=img_name)
+    manifest.write(json.dumps(entry) + '\n')
+    manifest.flush()
+    done.add((method, img_name))
+
+
+def refine(depths, desc):
+    """Refine depths, either one method's array or a dict of arrays keyed by method, and save the results"""
+    # occlusion and aux inputs are prefetched by worker processes while the network runs
+    dataset = NYUv2(opt.occ_dir, opt.data_dir, depths, th=opt.th, aux_type=aux_type, occ_ext=opt.occ_ext)
+    batch_methods = dataset.methods if dataset.methods is not None else [desc]
+    stacked = dataset.methods is not None
+    im_names = dataset.im_names
+
+    # skip images already refined for every method
+    todo = [i for i, name in enumerate(dataset.im_names) if any((m, name) not in done for m in batch_methods)]
+    if len(todo) == 0:
+        print('{}: all {} images already refined, skipping'.format(desc, len(dataset)))
+        return
+    if len(todo) < len(dataset):
+        print('{}: resuming with {} of {} images'.format(desc, len(todo), len(dataset)))
+        dataset = Subset(dataset, todo)
+    data_loader = DataLoader(dataset, batch_size=opt.batch_size, shuffle=False, num_workers=opt.workers,
+                             pin_memory=(device.type == 'cuda'))
+
+    latency = []
     with torch.no_grad():
-        for i in tqdm(range(len(occ_list)), desc='refining depth prediction from {}'.format(method)):
-            depth_coarse = depths[i].unsqueeze(0).cuda()
-
-            occlusion = np.load(os.path.join(opt.occ_dir, occ_list[i]))
-
-            # remove predictions with small score
-            mask = occlusion[:, :, 0] <= opt.th
-            occlusion[mask, 1:] = 0
-
-            occlusion = padding_array(occlusion)
-            occlusion = occlusion.unsqueeze(0).cuda()
+        for indices, depth_coarse, occlusion, aux in tqdm(data_loader, desc='refining depth prediction from {}'.format(desc)):
+            # stack (B, M, 1, H, W) depths into a (B * M, 1, H, W) batch sharing each image's inputs
+            num_methods = len(batch_methods)
+            if stacked:
+                depth_coarse = depth_coarse.flatten(0, 1)
+                occlusion = occlusion.repeat_interleave(num_methods, dim=0)
+                aux = aux.repeat_interleave(num_methods, dim=0)
+
+            depth_coarse = to_device(depth_coarse, device)
+            occlusion = to_device(occlusion, device)
+            aux = to_device(aux, device) if aux_type is not None else None
 
             # forward pass
-            if opt.use_normal:
-                aux = cv2.imread(os.path.join(opt.data_dir, normal_list[i]), -1) / (2 ** 16 - 1) * 2 - 1
-            elif opt.use_img:
-                aux = cv2.imread(os.path.join(opt.data_dir, img_list[i]), -1) / 255
-            else:
-                aux = None
-            if aux is not None:
-                aux = padding_array(aux).unsqueeze(0).cuda()
+            synchronize(device)
+            begin = time.time()
             pred = net(depth_coarse, occlusion, aux)
-
-            depth_refine = pred.clamp(1e-9).squeeze().cpu().numpy()
-            depth_init = depth_coarse.squeeze().cpu().numpy()
-
-            img_name = occ_list[i].split('-')[0]
-            refine_name = os.path.join(opt.result_dir, method, 'depth_refine', '{}.png'.format(img_name))
-            init_name = os.path.join(opt.result_dir, method, 'depth_init', '{}.png'.format(img_name))
-            save_name = os.path.join(opt.result_dir, method, 'depth_npy', '{}.npy'.format(img_name))
-
-            if not os.path.isdir(os.path.dirname(refine_name)):
-                os.makedirs(os.path.dirname(refine_name))
-            if not os.path.isdir(os.path.dirname(init_name)):
-                os.makedirs(os.path.dirname(init_name))
-            if not os.path.isdir(os.path.dirname(save_name)):
-                os.makedirs(os.path.dirname(save_name))
-
-            plt.imsave(refine_name, depth_refine)
-            plt.imsave(init_name, depth_init)
-
-            np.save(save_name, depth_refine)
+            synchronize(device)
+            latency.append((time.time() - begin) / depth_coarse.shape[0])
+
+            depth_refines = pred.clamp(1e-9).squeeze(1).cpu().numpy()
+            depth_inits = depth_coarse.squeeze(1).cpu().numpy()
+
+            # fan the results out to the per-method output directories
+            for k, index in enumerate(indices.tolist()):
+                for m, method in enumerate(batch_methods):
+                    if (method, im_names[index]) in done:
+                        continue
+                    save_outputs(method, im_names[index],
+                                 depth_refines[k * num_methods + m], depth_inits[k * num_methods + m])
+
+    print('{}: per-image latency on {}: mean {:.1f} ms, median {:.1f} ms'.format(
+        desc, device, np.mean(latency) * 1000, np.median(latency) * 1000))
+
+
+# completed (method, image) pairs are recorded in a manifest so that interrupted runs can be resumed
+if not os.path.isdir(opt.result_dir):
+    os.makedirs(opt.result_dir)
+run_key = {'checkpoint': checkpoint_hash(opt.checkpoint), 'th': opt.th}
+manifest_path = os.path.join(opt.result_dir, 'manifest.jsonl')
+done = load_manifest()
+manifest = open(manifest_path, 'a')
+
+if opt.single_pass:
+    # depths of all methods are decoded lazily, image by image
+    all_depths = dict()
+    for method in opt.methods:
+        all_depths[method] = get_prediction_source(method, opt.pred_store)
+    refine(all_depths, ', '.join(opt.methods))
+else:
+    for method in tqdm(opt.methods):
+        refine(get_prediction_source(method, opt.pred_store), method)
+
+manifest.close()
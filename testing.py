@@ -4,19 +4,19 @@ import torch
 from torch.utils.data import DataLoader
 import torch.optim as optim
 import os
+import time
 from tqdm import tqdm
 from PIL import Image
 
-import matplotlib
-matplotlib.use('agg')  # use matplotlib without GUI support
-import matplotlib.pyplot as plt
-
 from lib.models.unet import UNet
 from lib.datasets.ibims import Ibims
 
-from lib.utils.net_utils import load_checkpoint
-from lib.utils.evaluate_ibims_error_metrics import compute_global_errors, \
-    compute_depth_boundary_error, compute_directed_depth_error
+from lib.utils.net_utils import load_checkpoint, setup_device, prepare_inference_model, to_device, synchronize
+from lib.utils.batch_metrics import compute_global_errors_batch, compute_directed_depth_error_batch
+from lib.utils.async_eval import AsyncBoundaryEvaluator
+from lib.utils.metrics import MetricsAccumulator
+from lib.utils.async_writer import AsyncResultWriter
+from lib.utils.colormap import save_colorized
 
 # =================PARAMETERS=============================== #
 parser = argparse.ArgumentParser()
@@ -31,23 +31,46 @@ parser.add_argument('--only_contour', action='store_true', help='whether to keep
 parser.add_argument('--th', type=float, default=0.5)
 parser.add_argument('--lr', type=float, default=0.0001, help='learning rate of optimizer')
 
+# device settings
+parser.add_argument('--device', type=str, default='cuda', help='device to run inference on, e.g. cuda, cuda:1 or cpu')
+parser.add_argument('--num_threads', type=int, default=None, help='intra-op threads on cpu, default to the physical cores')
+parser.add_argument('--interop_threads', type=int, default=None, help='inter-op threads on cpu, default to 1')
+
 # pth settings
 parser.add_argument('--checkpoint', type=str, default=None, help='optional reload model path')
 parser.add_argument('--result_dir', type=str, default='result', help='result folder')
 
+# output settings
+parser.add_argument('--no_npy', action='store_true', help='whether to skip saving depth maps as npy files')
+parser.add_argument('--no_vis', action='store_true', help='whether to skip saving colormapped depth maps')
+parser.add_argument('--no_mm', action='store_true', help='whether to skip saving depth maps as millimetre pngs')
+parser.add_argument('--writer_workers', type=int, default=2,
+                    help='threads saving the outputs alongside the network, 0 to save them inline')
+
 # dataset settings
 parser.add_argument('--val_dir', type=str, default='/space_sdd/ibims', help='testing dataset')
 parser.add_argument('--val_method', type=str, default='junli')
 parser.add_argument('--val_label_dir', type=str, default='contour_pred')
 parser.add_argument('--val_label_ext', type=str, default='-rgb-order-pix.npy')
+parser.add_argument('--val_cache_dir', type=str, default=None,
+                    help='folder where decoded samples are saved and reused by later runs')
+
+parser.add_argument('--dbe_workers', type=int, default=4,
+                    help='processes computing depth boundary errors alongside the network, 0 to compute them inline')
+parser.add_argument('--gt_dist_cache', type=str, default=None,
+                    help='folder where distance transforms of the ground truth edges are saved and reused')
 
 opt = parser.parse_args()
 print(opt)
+
+dbe_evaluator = AsyncBoundaryEvaluator(opt.dbe_workers, gt_cache_dir=opt.gt_dist_cache)
+result_writer = AsyncResultWriter(opt.writer_workers)
 # ========================================================== #
 
 
 # =================CREATE DATASET=========================== #
-dataset_val = Ibims(opt.val_dir, opt.val_method, th=opt.th, label_dir=opt.val_label_dir, label_ext=opt.val_label_ext)
+dataset_val = Ibims(opt.val_dir, opt.val_method, th=opt.th, label_dir=opt.val_label_dir, label_ext=opt.val_label_ext,
+                    cache=('disk' if opt.val_cache_dir is not None else None), cache_dir=opt.val_cache_dir)
 val_loader = DataLoader(dataset_val, batch_size=1, shuffle=False)
 
 with open('/space_sdd/ibims/imagelist.txt') as f:
@@ -61,30 +84,40 @@ net = UNet(use_occ=opt.use_occ, no_contour=opt.no_contour, only_contour=opt.only
            use_aux=(opt.use_normal or opt.use_img))
 optimizer = optim.Adam(net.parameters(), lr=opt.lr)
 
-load_checkpoint(net, optimizer, opt.checkpoint)
+device = setup_device(opt.device, opt.num_threads, opt.interop_threads)
+load_checkpoint(net, optimizer, opt.checkpoint, device)
 
-net.cuda()
+prepare_inference_model(net, device)
 # ========================================================== #
 
 
 # ===================== DEFINE TEST ======================== #
-def test(data_loader, net, result_dir):
-    # Initialize global and geometric errors ...
-    num_samples = len(data_loader)
-    rms = np.zeros(num_samples, np.float32)
-    log10 = np.zeros(num_samples, np.float32)
-    abs_rel = np.zeros(num_samples, np.float32)
-    sq_rel = np.zeros(num_samples, np.float32)
-    thr1 = np.zeros(num_samples, np.float32)
-    thr2 = np.zeros(num_samples, np.float32)
-    thr3 = np.zeros(num_samples, np.float32)
+def save_results(result_dir, img_name, gt, pred, init):
+    """Save the gt, refined and initial depth maps of one image, run by the result writer"""
+    depths = [('gt', gt), ('refine', pred), ('init', init)]
+
+    # save npy files
+    if not opt.no_npy:
+        for suffix, depth in depths:
+            np.save(os.path.join(result_dir, '{}_{}.npy'.format(img_name, suffix)), depth)
 
-    dbe_acc = np.zeros(num_samples, np.float32)
-    dbe_com = np.zeros(num_samples, np.float32)
+    if not opt.no_vis:
+        max_value = max(gt.max(), pred.max(), init.max())
+        for suffix, depth in depths:
+            save_colorized(os.path.join(result_dir, '{}_{}.png'.format(img_name, suffix)), depth, vmin=0, vmax=max_value)
 
-    dde_0 = np.zeros(num_samples, np.float32)
-    dde_m = np.zeros(num_samples, np.float32)
-    dde_p = np.zeros(num_samples, np.float32)
+    if not opt.no_mm:
+        for suffix, depth in depths:
+            depth_mm = Image.fromarray((depth * 1000).astype('int32'))
+            depth_mm.save(os.path.join(result_dir, '{}_{}_mm.png'.format(img_name, suffix)))
+
+
+def test(data_loader, net, result_dir):
+    # running means of global and geometric errors ...
+    metrics = MetricsAccumulator()
+
+    num_samples = len(data_loader)
+    latency = np.zeros(num_samples, np.float32)
 
     net.eval()
     with torch.no_grad():
@@ -92,7 +125,8 @@ def test(data_loader, net, result_dir):
             # load data and label
             depth_gt, depth_coarse, occlusion, edge, normal, img = data
             depth_gt, depth_coarse, occlusion, normal, img = \
-                depth_gt.cuda(), depth_coarse.cuda(), occlusion.cuda(), normal.cuda(), img.cuda()
+                depth_gt.to(device), to_device(depth_coarse, device), to_device(occlusion, device), \
+                to_device(normal, device), to_device(img, device)
 
             # forward pass
             if opt.use_normal:
@@ -101,7 +135,11 @@ def test(data_loader, net, result_dir):
                 aux = img
             else:
                 aux = None
+            synchronize(device)
+            begin = time.time()
             depth_pred = net(depth_coarse, occlusion, aux).clamp(1e-9)
+            synchronize(device)
+            latency[i] = time.time() - begin
 
             # mask out invalid depth values
             valid_mask = (depth_gt != 0).float()
@@ -115,35 +153,21 @@ def test(data_loader, net, result_dir):
             init = init_valid.squeeze().cpu().numpy()
             edge = edge.numpy()
 
-            # save npy files
-            np.save(os.path.join(result_dir, '{}_init.npy'.format(image_names[i])), init)
-            np.save(os.path.join(result_dir, '{}_refine.npy'.format(image_names[i])), pred)
-            np.save(os.path.join(result_dir, '{}_gt.npy'.format(image_names[i])), gt)
-
-            gt_name = os.path.join(result_dir, '{}_gt.png'.format(image_names[i]))
-            pred_name = os.path.join(result_dir, '{}_refine.png'.format(image_names[i]))
-            init_name = os.path.join(result_dir, '{}_init.png'.format(image_names[i]))
-            max_value = max(gt.max(), pred.max(), init.max())
-            plt.imsave(gt_name, gt, vmin=0, vmax=max_value)
-            plt.imsave(pred_name, pred, vmin=0, vmax=max_value)
-            plt.imsave(init_name, init, vmin=0, vmax=max_value)
-
-            gt_mm = Image.fromarray((gt * 1000).astype('int32'))
-            gt_mm.save(os.path.join(result_dir, '{}_gt_mm.png'.format(image_names[i])))
-            refine_mm = Image.fromarray((pred * 1000).astype('int32'))
-            refine_mm.save(os.path.join(result_dir, '{}_refine_mm.png'.format(image_names[i])))
-            init_mm = Image.fromarray((init * 1000).astype('int32'))
-            init_mm.save(os.path.join(result_dir, '{}_init_mm.png'.format(image_names[i])))
+            # encode and save the outputs in the background
+            result_writer.submit(save_results, result_dir, image_names[i], gt, pred, init)
 
+            metrics.update_global(compute_global_errors_batch(gt_valid, pred_valid))
+            dbe_evaluator.submit(edge, pred, image_names[i])
+            metrics.update_directed(compute_directed_depth_error_batch(gt_valid, pred_valid, 3.0))
 
-            gt_vec = gt.flatten()
-            pred_vec = pred.flatten()
+    print('per-image latency on {}: mean {:.1f} ms, median {:.1f} ms'.format(
+        device, np.mean(latency) * 1000, np.median(latency) * 1000))
 
-            abs_rel[i], sq_rel[i], rms[i], log10[i], thr1[i], thr2[i], thr3[i] = compute_global_errors(gt_vec, pred_vec)
-            dbe_acc[i], dbe_com[i], est_edges = compute_depth_boundary_error(edge, pred)
-            dde_0[i], dde_m[i], dde_p[i] = compute_directed_depth_error(gt_vec, pred_vec, 3.0)
+    # collect the depth boundary errors computed by the workers and finish writing the outputs
+    dbe_evaluator.wait(metrics)
+    result_writer.flush()
 
-    return abs_rel, sq_rel, rms, log10, thr1, thr2, thr3, dbe_acc, dbe_com, dde_0, dde_m, dde_p
+    return metrics
 # ========================================================== #
 
 
@@ -154,37 +178,13 @@ result_dir = os.path.join(opt.result_dir, session_name, opt.val_method, testing_
 if not os.path.exists(result_dir):
     os.makedirs(result_dir)
 
-abs_rel, sq_rel, rms, log10, thr1, thr2, thr3, dbe_acc, dbe_com, dde_0, dde_m, dde_p = test(val_loader, net, result_dir)
-print('############ Global Error Metrics #################')
-print('rel    = ',  np.nanmean(abs_rel))
-print('log10  = ',  np.nanmean(log10))
-print('rms    = ',  np.nanmean(rms))
-print('thr1   = ',  np.nanmean(thr1))
-print('thr2   = ',  np.nanmean(thr2))
-print('thr3   = ',  np.nanmean(thr3))
-print('############ Depth Boundary Error Metrics #################')
-print('dbe_acc = ',  np.nanmean(dbe_acc))
-print('dbe_com = ',  np.nanmean(dbe_com))
-print('############ Directed Depth Error Metrics #################')
-print('dde_0  = ',  np.nanmean(dde_0)*100.)
-print('dde_m  = ',  np.nanmean(dde_m)*100.)
-print('dde_p  = ',  np.nanmean(dde_p)*100.)
+metrics = test(val_loader, net, result_dir)
+print(metrics.report(precision=None), end='')
 
 
 # log testing reults
 logname = os.path.join(result_dir, 'testing_{}.txt'.format(testing_mode))
 with open(logname, 'w') as f:
-    f.write('############ Global Error Metrics #################\n')
-    f.write('rel    =  {:.3f}\n'.format(np.nanmean(abs_rel)))
-    f.write('log10  =  {:.3f}\n'.format(np.nanmean(log10)))
-    f.write('rms    =  {:.3f}\n'.format(np.nanmean(rms)))
-    f.write('thr1   =  {:.3f}\n'.format(np.nanmean(thr1)))
-    f.write('thr2   =  {:.3f}\n'.format(np.nanmean(thr2)))
-    f.write('thr3   =  {:.3f}\n'.format(np.nanmean(thr3)))
-    f.write('############ Depth Boundary Error Metrics #################\n')
-    f.write('dbe_acc = {:.3f}\n'.format(np.nanmean(dbe_acc)))
-    f.write('dbe_com = {:.3f}\n'.format(np.nanmean(dbe_com)))
-    f.write('############ Directed Depth Error Metrics #################\n')
-    f.write('dde_0  = {:.3f}\n'.format(np.nanmean(dde_0) * 100.))
-    f.write('dde_m  = {:.3f}\n'.format(np.nanmean(dde_m) * 100.))
-    f.write('dde_p  = {:.3f}\n\n'.format(np.nanmean(dde_p) * 100.))
+    f.write(metrics.report() + '\n')
+metrics.save_json(os.path.join(result_dir, 'testing_{}.json'.format(testing_mode)),
+                  checkpoint=opt.checkpoint, method=opt.val_method, mode=testing_mode)
@@ -1,4 +1,5 @@
 import argparse
+import inspect
 import numpy as np
 import torch
 from torch.utils.data import DataLoader
@@ -8,12 +9,15 @@ import time
 
 from lib.models.unet import UNet
 from lib.datasets.ibims import Ibims
-from lib.datasets.interior_net import InteriorNet
+from lib.datasets.interior_net import InteriorNet, InteriorNetShards
 
 from lib.utils.net_utils import kaiming_init, weights_normal_init, save_checkpoint, load_checkpoint, \
-    berhu_loss, spatial_gradient_loss, occlusion_aware_loss, create_gamma_matrix
-from lib.utils.evaluate_ibims_error_metrics import compute_global_errors, \
-    compute_depth_boundary_error, compute_directed_depth_error
+    RefinementLoss, get_gamma_tensor, setup_device, autocast, \
+    create_grad_scaler, reset_peak_memory, peak_memory
+from lib.utils.batch_metrics import compute_global_errors_batch, compute_directed_depth_error_batch
+from lib.utils.async_eval import AsyncBoundaryEvaluator
+from lib.utils.metrics import MetricsAccumulator
+from lib.utils.prefetcher import DevicePrefetcher
 
 # =================PARAMETERS=============================== #
 parser = argparse.ArgumentParser()
@@ -40,6 +44,9 @@ parser.add_argument('--batch_size', type=int, default=8, help='input batch size'
 parser.add_argument('--workers', type=int, help='number of data loading workers', default=2)
 parser.add_argument('--epoch', type=int, default=100, help='number of epochs to train for')
 parser.add_argument('--print_freq', type=int, default=50, help='frequence of output print')
+parser.add_argument('--device', type=str, default='cuda', help='device to train on, e.g. cuda, cuda:1 or cpu')
+parser.add_argument('--amp', action='store_true',
+                    help='whether to train with mixed precision, float16 on gpu and bfloat16 on cpu')
 
 # pth settings
 parser.add_argument('--session', type=int, default=0, help='training session')
@@ -50,22 +57,58 @@ parser.add_argument('--save_dir', type=str, default='model', help='save model pa
 # dataset settings
 parser.add_argument('--train_dir', type=str, default='/space_sdd/InteriorNet', help='training dataset')
 parser.add_argument('--train_method', type=str, default='sharpnet_pred')
+parser.add_argument('--train_label_ext', type=str, default='-order-pix.npy',
+                    help='-order-pix.npy for raw occlusion labels or -order-pix.npz for compact ones')
+parser.add_argument('--train_shards', type=str, default=None, help='folder of packed training shards, used instead of train_dir')
 parser.add_argument('--val_dir', type=str, default='/space_sdd/ibims', help='testing dataset')
 parser.add_argument('--val_method', type=str, default='sharpnet')
 parser.add_argument('--val_label_dir', type=str, default='label')
 parser.add_argument('--val_label_ext', type=str, default='-order-pix.npy')
+parser.add_argument('--val_cache', type=str, default=None, choices=['memory', 'disk'],
+                    help='keep decoded validation samples in memory or on disk across epochs')
+parser.add_argument('--val_cache_dir', type=str, default=None, help='folder of the disk cache')
+
+parser.add_argument('--dbe_workers', type=int, default=4,
+                    help='processes computing depth boundary errors alongside the network, 0 to compute them inline')
+parser.add_argument('--gt_dist_cache', type=str, default=None,
+                    help='folder where distance transforms of the ground truth edges are saved and reused')
 
 opt = parser.parse_args()
 print(opt)
+
+dbe_evaluator = AsyncBoundaryEvaluator(opt.dbe_workers, gt_cache_dir=opt.gt_dist_cache)
+device = setup_device(opt.device)
 # ========================================================== #
 
 
 # =================CREATE DATASET=========================== #
-dataset_train = InteriorNet(opt.train_dir, method_name=opt.train_method)
-dataset_val = Ibims(opt.val_dir, opt.val_method, th=opt.th, label_dir=opt.val_label_dir, label_ext=opt.val_label_ext)
-
-train_loader = DataLoader(dataset_train, batch_size=opt.batch_size, shuffle=True, num_workers=opt.workers, drop_last=True)
-val_loader = DataLoader(dataset_val, batch_size=1, shuffle=False, num_workers=opt.workers)
+# shards must be packed from the same labels and predictions as the raw files
+train_label_name = '_raycastingV2'
+if opt.train_shards is not None:
+    dataset_train = InteriorNetShards(opt.train_shards, label_name=train_label_name, method_name=opt.train_method)
+else:
+    dataset_train = InteriorNet(opt.train_dir, label_name=train_label_name, method_name=opt.train_method,
+                                label_ext=opt.train_label_ext)
+dataset_val = Ibims(opt.val_dir, opt.val_method, th=opt.th, label_dir=opt.val_label_dir, label_ext=opt.val_label_ext,
+                    cache=opt.val_cache, cache_dir=opt.val_cache_dir)
+
+train_loader = DataLoader(dataset_train, batch_size=opt.batch_size, shuffle=True, num_workers=opt.workers, drop_last=True,
+                          pin_memory=(device.type == 'cuda'))
+# keep workers alive across epochs so that they keep their memory cache, persistent workers need torch 1.7
+val_loader_kwargs = dict()
+val_workers = opt.workers
+if opt.val_cache == 'memory' and val_workers > 0:
+    if 'persistent_workers' in inspect.signature(DataLoader).parameters:
+        val_loader_kwargs['persistent_workers'] = True
+    else:
+        print('persistent_workers needs torch 1.7, loading validation samples in the main process to keep the memory cache')
+        val_workers = 0
+val_loader = DataLoader(dataset_val, batch_size=1, shuffle=False, num_workers=val_workers, pin_memory=(device.type == 'cuda'),
+                        **val_loader_kwargs)
+
+# copy the next batch to the gpu while the current one is processed, edges stay on the host for the metrics
+train_loader = DevicePrefetcher(train_loader, device)
+val_loader = DevicePrefetcher(val_loader, device, keep_on_host=(3,))
 # ========================================================== #
 
 
@@ -79,13 +122,17 @@ optimizer = optim.Adam(net.parameters(), lr=opt.lr)
 lrScheduler = optim.lr_scheduler.MultiStepLR(optimizer, [opt.step], gamma=0.1)
 
 if opt.resume:
-    start_epoch = load_checkpoint(net, optimizer, opt.checkpoint)
+    start_epoch = load_checkpoint(net, optimizer, opt.checkpoint, device)
 else:
     start_epoch = 0
 
-net.cuda()
-gamma = create_gamma_matrix(480, 640, 600, 600)
-gamma = torch.from_numpy(gamma).float().cuda()
+net.to(device)
+gamma = get_gamma_tensor(480, 640, 600, 600, device=device)
+criterion = RefinementLoss(15. / 1000, 1, alpha_depth=opt.alpha_depth, alpha_occ=opt.alpha_occ,
+                           alpha_change=opt.alpha_change, mask_contour=opt.mask).to(device)
+
+# gradients are scaled to keep small float16 gradients from flushing to zero
+scaler = create_grad_scaler(device, opt.amp)
 # ========================================================== #
 
 
@@ -104,12 +151,12 @@ with open(logname, 'a') as f:
 # =================== DEFINE TRAIN ========================= #
 def train(data_loader, net, optimizer):
     net.train()
+    reset_peak_memory(device)
     end = time.time()
+    epoch_begin = end
     for i, data in enumerate(data_loader):
         # load data and label
         depth_gt, depth_coarse, occlusion, normal, img = data
-        depth_gt, depth_coarse, occlusion, normal, img = \
-            depth_gt.cuda(), depth_coarse.cuda(), occlusion.cuda(), normal.cuda(), img.cuda()
 
         # forward pass
         if opt.use_normal:
@@ -118,72 +165,57 @@ def train(data_loader, net, optimizer):
             aux = img
         else:
             aux = None
-        #depth_pred = net(depth_coarse, occlusion, aux)
-        depth_refined = net(depth_coarse, occlusion, aux)
+        with autocast(device, opt.amp):
+            #depth_pred = net(depth_coarse, occlusion, aux)
+            depth_refined = net(depth_coarse, occlusion, aux)
 
-        # compute losses and update the meters
-        if opt.mask:
-            mask = (occlusion[:, 0, :, :] == 0).float().unsqueeze(1)
-        else:
-            mask = (occlusion[:, 0, :, :] >= 0).float().unsqueeze(1)
-
-        # ground truth depth loss
-        loss_depth_gt = berhu_loss(depth_refined, depth_gt) + spatial_gradient_loss(depth_refined, depth_gt, mask)
-
-        # occlusion loss
-        loss_depth_occ = occlusion_aware_loss(depth_refined, occlusion, normal, gamma, 15. / 1000, 1)
-
-        # regularization loss
-        loss_change = berhu_loss(depth_refined, depth_coarse) + spatial_gradient_loss(depth_refined, depth_coarse, mask)
-
-        loss = opt.alpha_depth * loss_depth_gt + \
-               opt.alpha_occ * loss_depth_occ + \
-               opt.alpha_change * loss_change
+            # compute losses and update the meters
+            loss, losses = criterion(depth_refined, depth_gt, depth_coarse, occlusion, normal, gamma)
 
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         # measure bacth time
         batch_time = time.time() - end
         end = time.time()
 
         if i % opt.print_freq == 0:
-            print("\tEpoch {} --- Iter [{}/{}] Gt_depth loss: {:.3f}  Occ loss: {:.3f}  Change loss: {:.3f} || Batch time: {:.3f}".format(
+            print("\tEpoch {} --- Iter [{}/{}] Gt_depth loss: {:.3f}  Occ loss: {:.3f}  Change loss: {:.3f} || Batch time: {:.3f}  Data time: {:.3f}".format(
                   epoch, i + 1, len(data_loader),
-                  opt.alpha_depth * loss_depth_gt.item(),
-                  opt.alpha_occ * loss_depth_occ.item(),
-                  opt.alpha_change * loss_change.item(),
-                  batch_time))
+                  opt.alpha_depth * losses['depth_gt'].item(),
+                  opt.alpha_occ * losses['occ'].item(),
+                  opt.alpha_change * losses['change'].item(),
+                  batch_time, data_loader.wait_time / data_loader.num_batches))
+
+    # time the loop spent waiting on the data loader rather than training
+    epoch_time = time.time() - epoch_begin
+    print("\tEpoch {} --- waited {:.1f}s on data out of {:.1f}s".format(epoch, data_loader.wait_time, epoch_time))
+
+    # log throughput and peak memory so that --amp and float32 runs can be compared
+    message = 'Epoch {} --- {}: {:.1f} images/s'.format(
+        epoch, 'amp' if opt.amp else 'fp32', data_loader.num_batches * opt.batch_size / epoch_time)
+    memory = peak_memory(device)
+    if memory is not None:
+        message += ', peak memory {:.0f} MB'.format(memory)
+    print('\t' + message)
+    with open(logname, 'a') as f:
+        f.write(message + '\n')
 # ========================================================== #
 
 
 # ===================== DEFINE VAL ========================= #
 def val(data_loader, net):
-    # Initialize global and geometric errors ...
-    num_samples = len(data_loader)
-    rms     = np.zeros(num_samples, np.float32)
-    log10   = np.zeros(num_samples, np.float32)
-    abs_rel = np.zeros(num_samples, np.float32)
-    sq_rel  = np.zeros(num_samples, np.float32)
-    thr1    = np.zeros(num_samples, np.float32)
-    thr2    = np.zeros(num_samples, np.float32)
-    thr3    = np.zeros(num_samples, np.float32)
-
-    dbe_acc = np.zeros(num_samples, np.float32)
-    dbe_com = np.zeros(num_samples, np.float32)
-
-    dde_0 = np.zeros(num_samples, np.float32)
-    dde_m = np.zeros(num_samples, np.float32)
-    dde_p = np.zeros(num_samples, np.float32)
+    # running means of global and geometric errors ...
+    metrics = MetricsAccumulator()
 
     net.eval()
+    begin = 0
     with torch.no_grad():
-        for i, data in enumerate(data_loader):
+        for data in data_loader:
             # load data and label
             depth_gt, depth_coarse, occlusion, edge, normal, img = data
-            depth_gt, depth_coarse, occlusion, normal, img = \
-                depth_gt.cuda(), depth_coarse.cuda(), occlusion.cuda(), normal.cuda(), img.cuda()
 
             # forward pass
             if opt.use_normal:
@@ -192,46 +224,36 @@ def val(data_loader, net):
                 aux = img
             else:
                 aux = None
-            depth_pred = net(depth_coarse, occlusion, aux)
+            with autocast(device, opt.amp):
+                depth_pred = net(depth_coarse, occlusion, aux).float()
 
             # mask out invalid depth values
             valid_mask = (depth_gt != 0).float()
             gt_valid = depth_gt * valid_mask
             pred_valid = depth_pred.clamp(1e-9) * valid_mask
 
-            # get numpy array from torch tensor
-            gt = gt_valid.squeeze().cpu().numpy()
-            pred = pred_valid.squeeze().cpu().numpy()
-            edge = edge.numpy()
+            # compute global and directed errors for the whole batch on device
+            metrics.update_global(compute_global_errors_batch(gt_valid, pred_valid))
+            metrics.update_directed(compute_directed_depth_error_batch(gt_valid, pred_valid, 3.0))
 
-            gt_vec = gt.flatten()
-            pred_vec = pred.flatten()
+            # get numpy array from torch tensor for the depth boundary errors
+            preds = pred_valid.squeeze(1).cpu().numpy()
+            edges = edge.numpy()
+            for k in range(len(preds)):
+                dbe_evaluator.submit(edges[k], preds[k], data_loader.dataset.im_names[begin + k])
+            begin += len(preds)
 
-            abs_rel[i], sq_rel[i], rms[i], log10[i], thr1[i], thr2[i], thr3[i] = compute_global_errors(gt_vec, pred_vec)
-            dbe_acc[i], dbe_com[i], est_edges = compute_depth_boundary_error(edge, pred)
-            dde_0[i], dde_m[i], dde_p[i] = compute_directed_depth_error(gt_vec, pred_vec, 3.0)
+    # collect the depth boundary errors computed by the workers
+    dbe_evaluator.wait(metrics)
 
-    return abs_rel, sq_rel, rms, log10, thr1, thr2, thr3, dbe_acc, dbe_com, dde_0, dde_m, dde_p
+    return metrics
 # ========================================================== #
 
 
 # =============BEGIN OF THE LEARNING LOOP=================== #
 # initialization
-abs_rel, sq_rel, rms, log10, thr1, thr2, thr3, dbe_acc, dbe_com, dde_0, dde_m, dde_p = val(val_loader, net)
-print('############ Global Error Metrics #################')
-print('rel    = ',  np.nanmean(abs_rel))
-print('log10  = ',  np.nanmean(log10))
-print('rms    = ',  np.nanmean(rms))
-print('thr1   = ',  np.nanmean(thr1))
-print('thr2   = ',  np.nanmean(thr2))
-print('thr3   = ',  np.nanmean(thr3))
-print('############ Depth Boundary Error Metrics #################')
-print('dbe_acc = ',  np.nanmean(dbe_acc))
-print('dbe_com = ',  np.nanmean(dbe_com))
-print('############ Directed Depth Error Metrics #################')
-print('dde_0  = ',  np.nanmean(dde_0)*100.)
-print('dde_m  = ',  np.nanmean(dde_m)*100.)
-print('dde_p  = ',  np.nanmean(dde_p)*100.)
+metrics = val(val_loader, net)
+print(metrics.report(precision=None), end='')
 
 best_rms = np.inf
 
@@ -243,29 +265,18 @@ for epoch in range(start_epoch, opt.epoch):
     train(train_loader, net, optimizer)    
 
     # valuate
-    abs_rel, sq_rel, rms, log10, thr1, thr2, thr3, dbe_acc, dbe_com, dde_0, dde_m, dde_p = val(val_loader, net)
+    metrics = val(val_loader, net)
+    rms = metrics.summary()['rms']
 
     # log testing reults
     with open(logname, 'a') as f:
         f.write('Results for {} epoch:\n'.format(epoch))
-        f.write('############ Global Error Metrics #################\n')
-        f.write('rel    =  {:.3f}\n'.format(np.nanmean(abs_rel)))
-        f.write('log10  =  {:.3f}\n'.format(np.nanmean(log10)))
-        f.write('rms    =  {:.3f}\n'.format(np.nanmean(rms)))
-        f.write('thr1   =  {:.3f}\n'.format(np.nanmean(thr1)))
-        f.write('thr2   =  {:.3f}\n'.format(np.nanmean(thr2)))
-        f.write('thr3   =  {:.3f}\n'.format(np.nanmean(thr3)))
-        f.write('############ Depth Boundary Error Metrics #################\n')
-        f.write('dbe_acc = {:.3f}\n'.format(np.nanmean(dbe_acc)))
-        f.write('dbe_com = {:.3f}\n'.format(np.nanmean(dbe_com)))
-        f.write('############ Directed Depth Error Metrics #################\n')
-        f.write('dde_0  = {:.3f}\n'.format(np.nanmean(dde_0) * 100.))
-        f.write('dde_m  = {:.3f}\n'.format(np.nanmean(dde_m) * 100.))
-        f.write('dde_p  = {:.3f}\n\n'.format(np.nanmean(dde_p) * 100.))
+        f.write(metrics.report() + '\n')
+    metrics.append_csv(os.path.join(result_path, 'val_metrics.csv'), epoch=epoch)
 
     # update best_rms and save checkpoint
-    if np.nanmean(rms) < best_rms:
-        best_rms = np.nanmean(rms)
+    if rms < best_rms:
+        best_rms = rms
         save_checkpoint({
             'epoch': epoch,
             'model': net.state_dict(),
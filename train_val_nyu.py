@@ -8,14 +8,16 @@ import os
 import time
 
 from lib.models.unet import UNet
-from lib.datasets.interior_net import InteriorNet
+from lib.datasets.interior_net import InteriorNet, InteriorNetShards
 
 from lib.utils.net_utils import kaiming_init, weights_normal_init, save_checkpoint, load_checkpoint, \
-    berhu_loss, spatial_gradient_loss, occlusion_aware_loss, create_gamma_matrix
-from lib.utils.evaluate_ibims_error_metrics import compute_global_errors, \
-    compute_depth_boundary_error, compute_directed_depth_error
-from lib.utils.data_utils import read_jiao, read_bts, read_dorn, read_eigen, read_laina, read_sharpnet, read_vnl, \
-    padding_array
+    RefinementLoss, get_gamma_tensor, setup_device, autocast, \
+    create_grad_scaler, reset_peak_memory, peak_memory
+from lib.utils.batch_metrics import compute_global_errors_batch, compute_directed_depth_error_batch
+from lib.utils.async_eval import AsyncBoundaryEvaluator
+from lib.utils.metrics import MetricsAccumulator
+from lib.utils.prefetcher import DevicePrefetcher
+from lib.utils.data_utils import get_prediction_source, padding_array, load_occlusion_label, PRED_STORE_DIR
 
 
 # =================PARAMETERS=============================== #
@@ -46,6 +48,9 @@ parser.add_argument('--batch_size', type=int, default=8, help='input batch size'
 parser.add_argument('--workers', type=int, help='number of data loading workers', default=2)
 parser.add_argument('--epoch', type=int, default=100, help='number of epochs to train for')
 parser.add_argument('--print_freq', type=int, default=50, help='frequence of output print')
+parser.add_argument('--device', type=str, default='cuda', help='device to train on, e.g. cuda, cuda:1 or cpu')
+parser.add_argument('--amp', action='store_true',
+                    help='whether to train with mixed precision, float16 on gpu and bfloat16 on cpu')
 
 # pth settings
 parser.add_argument('--resume', action='store_true', help='resume checkpoint or not')
@@ -55,45 +60,67 @@ parser.add_argument('--save_dir', type=str, default='model', help='save model pa
 # dataset settings
 parser.add_argument('--train_dir', type=str, default='/space_sdd/InteriorNet', help='training dataset')
 parser.add_argument('--train_method', type=str, default='sharpnet_pred')
+parser.add_argument('--train_label_ext', type=str, default='-order-pix.npy',
+                    help='-order-pix.npy for raw occlusion labels or -order-pix.npz for compact ones')
+parser.add_argument('--train_shards', type=str, default=None, help='folder of packed training shards, used instead of train_dir')
 
 parser.add_argument('--pred_method', type=str, default='jiao')
+parser.add_argument('--pred_store', type=str, default=PRED_STORE_DIR,
+                    help='folder of packed depth predictions, falls back to the raw files when the method is not packed')
+parser.add_argument('--pred_cache', type=int, default=0, help='number of decoded depth predictions kept in memory')
 parser.add_argument('--gt_depth', type=str, default='/space_sdd/NYU/nyuv2_depth.npy')
 parser.add_argument('--gt_boundary', type=str, default='/space_sdd/NYU/nyuv2_boundary.npy')
 parser.add_argument('--occ_dir', type=str, default='/space_sdd/NYU/nyu_order_pred')
+parser.add_argument('--occ_ext', type=str, default='.npy', help='.npy for raw occlusion labels or .npz for compact ones')
 parser.add_argument('--data_dir', type=str, default='/home/xuchong/Projects/occ_edge_order/data/dataset_real/NYUv2/data/val_occ_order_raycasting_woNormal_avgROI_1mm')
 
+parser.add_argument('--dbe_workers', type=int, default=4,
+                    help='processes computing depth boundary errors alongside the network, 0 to compute them inline')
+parser.add_argument('--gt_dist_cache', type=str, default=None,
+                    help='folder where distance transforms of the ground truth edges are saved and reused')
+
 opt = parser.parse_args()
 print(opt)
+
+dbe_evaluator = AsyncBoundaryEvaluator(opt.dbe_workers, gt_cache_dir=opt.gt_dist_cache)
+device = setup_device(opt.device)
 # ========================================================== #
 
 
 # =================CREATE DATASET=========================== #
-dataset_train = InteriorNet(opt.train_dir, method_name=opt.train_method, label_name='_raycastingV3_25mm_25mm')
-train_loader = DataLoader(dataset_train, batch_size=opt.batch_size, shuffle=True, num_workers=opt.workers, drop_last=True)
+# shards must be packed from the same labels and predictions as the raw files
+train_label_name = '_raycastingV3_25mm_25mm'
+if opt.train_shards is not None:
+    dataset_train = InteriorNetShards(opt.train_shards, label_name=train_label_name, method_name=opt.train_method)
+else:
+    dataset_train = InteriorNet(opt.train_dir, label_name=train_label_name, method_name=opt.train_method,
+                                label_ext=opt.train_label_ext)
+train_loader = DataLoader(dataset_train, batch_size=opt.batch_size, shuffle=True, num_workers=opt.workers, drop_last=True,
+                          pin_memory=(device.type == 'cuda'))
+# copy the next batch to the gpu while the current one is processed
+train_loader = DevicePrefetcher(train_loader, device)
 
 # define crop size for NYUv2
 eigen_crop = [21, 461, 25, 617]
 
 # load in depth prediction on validation dataset
-func = eval('read_{}'.format(opt.pred_method))
-pred_depths = func()
-pred_depths = torch.from_numpy(np.ascontiguousarray(pred_depths)).float().unsqueeze(1)
+pred_depths = get_prediction_source(opt.pred_method, opt.pred_store, cache_size=opt.pred_cache)
 
 # load gt depth and gt boundaries of validation dataset
 gt_depths = np.load(opt.gt_depth)
 gt_boundaries = np.load(opt.gt_boundary)
 
 # load in occlusion list
-occ_list = sorted([name for name in os.listdir(opt.occ_dir) if name.endswith(".npy")])
-assert len(occ_list) == pred_depths.shape[0], 'depth maps and occlusion maps does not match in quantity!'
+occ_list = sorted([name for name in os.listdir(opt.occ_dir) if name.endswith(opt.occ_ext)])
+assert len(occ_list) == len(pred_depths), 'depth maps and occlusion maps does not match in quantity!'
 
 # load in normal list
 normal_list = sorted([name for name in os.listdir(opt.data_dir) if name.endswith("-normal.png")])
-assert len(normal_list) == pred_depths.shape[0], 'normal maps and occlusion maps does not match in quantity!'
+assert len(normal_list) == len(pred_depths), 'normal maps and occlusion maps does not match in quantity!'
 
 # load in rgb list
 img_list = sorted([name for name in os.listdir(opt.data_dir) if name.endswith("-rgb.png")])
-assert len(img_list) == pred_depths.shape[0], 'rgb images and occlusion maps does not match in quantity!'
+assert len(img_list) == len(pred_depths), 'rgb images and occlusion maps does not match in quantity!'
 # ========================================================== #
 
 
@@ -107,13 +134,17 @@ optimizer = optim.Adam(net.parameters(), lr=opt.lr)
 lrScheduler = optim.lr_scheduler.MultiStepLR(optimizer, [opt.step], gamma=0.1)
 
 if opt.resume:
-    start_epoch = load_checkpoint(net, optimizer, opt.checkpoint)
+    start_epoch = load_checkpoint(net, optimizer, opt.checkpoint, device)
 else:
     start_epoch = 0
 
-net.cuda()
-gamma = create_gamma_matrix(480, 640, 600, 600)
-gamma = torch.from_numpy(gamma).float().cuda()
+net.to(device)
+gamma = get_gamma_tensor(480, 640, 600, 600, device=device)
+criterion = RefinementLoss(opt.delta / 1000, 1, var=opt.var, alpha_depth=opt.alpha_depth, alpha_occ=opt.alpha_occ,
+                           alpha_change=opt.alpha_change, mask_contour=opt.mask).to(device)
+
+# gradients are scaled to keep small float16 gradients from flushing to zero
+scaler = create_grad_scaler(device, opt.amp)
 # ========================================================== #
 
 
@@ -132,12 +163,12 @@ with open(logname, 'a') as f:
 # =================== DEFINE TRAIN ========================= #
 def train(data_loader, net, optimizer):
     net.train()
+    reset_peak_memory(device)
     end = time.time()
+    epoch_begin = end
     for i, data in enumerate(data_loader):
         # load data and label
         depth_gt, depth_coarse, occlusion, normal, img = data
-        depth_gt, depth_coarse, occlusion, normal, img = \
-            depth_gt.cuda(), depth_coarse.cuda(), occlusion.cuda(), normal.cuda(), img.cuda()
 
         # forward pass
         if opt.use_normal:
@@ -147,81 +178,64 @@ def train(data_loader, net, optimizer):
         else:
             aux = None
 
-        if opt.use_log:
-            depth_refined = depth_coarse * net(depth_coarse.log(), occlusion, aux).exp()
-        else:
-            depth_refined = net(depth_coarse, occlusion, aux)
-
-        # compute losses and update the meters
-        if opt.mask:
-            mask = (occlusion[:, 0, :, :] == 0).float().unsqueeze(1)
-        else:
-            mask = (occlusion[:, 0, :, :] >= 0).float().unsqueeze(1)
-
-        # ground truth depth loss
-        loss_depth_gt = berhu_loss(depth_refined, depth_gt) + spatial_gradient_loss(depth_refined, depth_gt, mask)
-
-        # occlusion loss
-        loss_depth_occ = occlusion_aware_loss(depth_refined, occlusion, normal, gamma, opt.delta / 1000, 1, opt.var)
-
-        # regularization loss
-        loss_change = berhu_loss(depth_refined, depth_coarse) + spatial_gradient_loss(depth_refined, depth_coarse, mask)
+        with autocast(device, opt.amp):
+            if opt.use_log:
+                depth_refined = depth_coarse * net(depth_coarse.log(), occlusion, aux).float().exp()
+            else:
+                depth_refined = net(depth_coarse, occlusion, aux)
 
-        loss = opt.alpha_depth * loss_depth_gt + \
-               opt.alpha_occ * loss_depth_occ + \
-               opt.alpha_change * loss_change
+            # compute losses and update the meters
+            loss, losses = criterion(depth_refined, depth_gt, depth_coarse, occlusion, normal, gamma)
 
         # optimization step
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         # measure batch time
         batch_time = time.time() - end
         end = time.time()
 
         if i % opt.print_freq == 0:
-            print("\tEpoch {} --- Iter [{}/{}] Gt_depth loss: {:.3f}  Occ loss: {:.3f}  Change loss: {:.3f} || Batch time: {:.3f}".format(
+            print("\tEpoch {} --- Iter [{}/{}] Gt_depth loss: {:.3f}  Occ loss: {:.3f}  Change loss: {:.3f} || Batch time: {:.3f}  Data time: {:.3f}".format(
                   epoch, i + 1, len(data_loader),
-                  opt.alpha_depth * loss_depth_gt.item(),
-                  opt.alpha_occ * loss_depth_occ.item(),
-                  opt.alpha_change * loss_change.item(),
-                  batch_time))
+                  opt.alpha_depth * losses['depth_gt'].item(),
+                  opt.alpha_occ * losses['occ'].item(),
+                  opt.alpha_change * losses['change'].item(),
+                  batch_time, data_loader.wait_time / data_loader.num_batches))
+
+    # time the loop spent waiting on the data loader rather than training
+    epoch_time = time.time() - epoch_begin
+    print("\tEpoch {} --- waited {:.1f}s on data out of {:.1f}s".format(epoch, data_loader.wait_time, epoch_time))
+
+    # log throughput and peak memory so that --amp and float32 runs can be compared
+    message = 'Epoch {} --- {}: {:.1f} images/s'.format(
+        epoch, 'amp' if opt.amp else 'fp32', data_loader.num_batches * opt.batch_size / epoch_time)
+    memory = peak_memory(device)
+    if memory is not None:
+        message += ', peak memory {:.0f} MB'.format(memory)
+    print('\t' + message)
+    with open(logname, 'a') as f:
+        f.write(message + '\n')
 # ========================================================== #
 
 
 # ===================== DEFINE VAL ========================= #
 def val(net):
-    # Initialize global and geometric errors ...
-    num_samples = len(occ_list)
-    rms     = np.zeros(num_samples, np.float32)
-    log10   = np.zeros(num_samples, np.float32)
-    abs_rel = np.zeros(num_samples, np.float32)
-    sq_rel  = np.zeros(num_samples, np.float32)
-    thr1    = np.zeros(num_samples, np.float32)
-    thr2    = np.zeros(num_samples, np.float32)
-    thr3    = np.zeros(num_samples, np.float32)
-
-    dbe_acc = np.zeros(num_samples, np.float32)
-    dbe_com = np.zeros(num_samples, np.float32)
-
-    dde_0 = np.zeros(num_samples, np.float32)
-    dde_m = np.zeros(num_samples, np.float32)
-    dde_p = np.zeros(num_samples, np.float32)
+    # running means of global and geometric errors ...
+    metrics = MetricsAccumulator()
 
     net.eval()
     with torch.no_grad():
         for i in range(len(occ_list)):
-            depth_coarse = pred_depths[i].unsqueeze(0).cuda()
+            depth_coarse = torch.from_numpy(np.array(pred_depths[i], dtype=np.float32))[None, None].to(device)
 
-            occlusion = np.load(os.path.join(opt.occ_dir, occ_list[i]))
-
-            # remove predictions with small score
-            mask = occlusion[:, :, 0] <= opt.th
-            occlusion[mask, 1:] = 0
+            # load occlusion and remove predictions with small score
+            occlusion = load_occlusion_label(os.path.join(opt.occ_dir, occ_list[i]), opt.th)
 
             occlusion = padding_array(occlusion)
-            occlusion = occlusion.unsqueeze(0).cuda()
+            occlusion = occlusion.unsqueeze(0).to(device)
 
             # forward pass
             if opt.use_normal:
@@ -231,28 +245,30 @@ def val(net):
             else:
                 aux = None
             if aux is not None:
-                aux = padding_array(aux).unsqueeze(0).cuda()
+                aux = padding_array(aux).unsqueeze(0).to(device)
 
-            if opt.use_log:
-                depth_refined = depth_coarse * net(depth_coarse.log(), occlusion, aux).exp()
-            else:
-                depth_refined = net(depth_coarse, occlusion, aux)
+            with autocast(device, opt.amp):
+                if opt.use_log:
+                    depth_refined = depth_coarse * net(depth_coarse.log(), occlusion, aux).float().exp()
+                else:
+                    depth_refined = net(depth_coarse, occlusion, aux).float()
+
+            pred = depth_refined.clamp(1e-9)[..., eigen_crop[0]:eigen_crop[1], eigen_crop[2]:eigen_crop[3]]
+            gt = gt_depths[i, eigen_crop[0]:eigen_crop[1], eigen_crop[2]:eigen_crop[3]]
+            gt = torch.from_numpy(np.ascontiguousarray(gt))[None, None].to(pred)
 
-            pred = depth_refined.clamp(1e-9)
+            metrics.update_global(compute_global_errors_batch(gt, pred))
+            metrics.update_directed(compute_directed_depth_error_batch(gt, pred, 3.0))
 
             # get numpy array from torch tensor
-            gt = gt_depths[i, eigen_crop[0]:eigen_crop[1], eigen_crop[2]:eigen_crop[3]]
             edge = gt_boundaries[i, eigen_crop[0]:eigen_crop[1], eigen_crop[2]:eigen_crop[3]]
-            pred = pred.squeeze().cpu().numpy()[eigen_crop[0]:eigen_crop[1], eigen_crop[2]:eigen_crop[3]]
-
-            gt_vec = gt.flatten()
-            pred_vec = pred.flatten()
+            pred = pred.squeeze().cpu().numpy()
+            dbe_evaluator.submit(edge, pred, occ_list[i].split('-')[0])
 
-            abs_rel[i], sq_rel[i], rms[i], log10[i], thr1[i], thr2[i], thr3[i] = compute_global_errors(gt_vec, pred_vec)
-            dbe_acc[i], dbe_com[i], est_edges = compute_depth_boundary_error(edge, pred)
-            dde_0[i], dde_m[i], dde_p[i] = compute_directed_depth_error(gt_vec, pred_vec, 3.0)
+    # collect the depth boundary errors computed by the workers
+    dbe_evaluator.wait(metrics)
 
-    return abs_rel, sq_rel, rms, log10, thr1, thr2, thr3, dbe_acc, dbe_com, dde_0, dde_m, dde_p
+    return metrics
 # ========================================================== #
 
 
@@ -267,29 +283,18 @@ for epoch in range(start_epoch, opt.epoch):
     train(train_loader, net, optimizer)
 
     # valuate
-    abs_rel, sq_rel, rms, log10, thr1, thr2, thr3, dbe_acc, dbe_com, dde_0, dde_m, dde_p = val(net)
+    metrics = val(net)
+    rms = metrics.summary()['rms']
 
     # log testing reults
     with open(logname, 'a') as f:
         f.write('Results for {} epoch:\n'.format(epoch))
-        f.write('############ Global Error Metrics #################\n')
-        f.write('rel    =  {:.3f}\n'.format(np.nanmean(abs_rel)))
-        f.write('log10  =  {:.3f}\n'.format(np.nanmean(log10)))
-        f.write('rms    =  {:.3f}\n'.format(np.nanmean(rms)))
-        f.write('thr1   =  {:.3f}\n'.format(np.nanmean(thr1)))
-        f.write('thr2   =  {:.3f}\n'.format(np.nanmean(thr2)))
-        f.write('thr3   =  {:.3f}\n'.format(np.nanmean(thr3)))
-        f.write('############ Depth Boundary Error Metrics #################\n')
-        f.write('dbe_acc = {:.3f}\n'.format(np.nanmean(dbe_acc)))
-        f.write('dbe_com = {:.3f}\n'.format(np.nanmean(dbe_com)))
-        f.write('############ Directed Depth Error Metrics #################\n')
-        f.write('dde_0  = {:.3f}\n'.format(np.nanmean(dde_0) * 100.))
-        f.write('dde_m  = {:.3f}\n'.format(np.nanmean(dde_m) * 100.))
-        f.write('dde_p  = {:.3f}\n\n'.format(np.nanmean(dde_p) * 100.))
+        f.write(metrics.report() + '\n')
+    metrics.append_csv(os.path.join(result_path, 'val_metrics.csv'), epoch=epoch)
 
     # update best_rms and save checkpoint
-    if np.nanmean(rms) < best_rms:
-        best_rms = np.nanmean(rms)
+    if rms < best_rms:
+        best_rms = rms
         save_checkpoint({
             'epoch': epoch,
             'model': net.state_dict(),